@@ -6,7 +6,14 @@ import logging
 sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 
 from src.repository.json_database import JSONDatabase as Database
-from src.services.analytics import Analytics as AnalyticsService
+from src.repository.quarantine import QuarantineSink
+from src.repository.claim_index import ClaimIndex
+from src.services.aggregate_cube import AggregateCube
+from src.services.analytics import Analytics
+from src.services.analytics_numpy import NumpyAnalytics
+from src.services.cent_accumulator import PRICE_SCALE, QUANTITY_SCALE
+from src.services.sampling import ApproximateAnalytics, StratifiedSampler
+from src.pipeline.pipeline import Pipeline, Stage, directory_fingerprint
 
 logging.basicConfig(
     level=logging.INFO,
@@ -15,23 +22,327 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+ENGINES = {"python": Analytics, "numpy": NumpyAnalytics}
+
+# Goal -> pipeline stage writing its output file
+GOAL_STAGES = {
+    "2": "metrics",
+    "3": "drug_recommendation_by_chains",
+    "4": "most_prescribed_quantity_by_drug",
+    "5": "unit_price_percentiles",
+}
+
+# Goal -> pipeline stage writing its approximate output file (--sample)
+SAMPLE_GOAL_STAGES = {
+    "2": "metrics_sample",
+    "3": "drug_recommendation_by_chains_sample",
+    "4": "most_prescribed_quantity_by_drug_sample",
+}
+
+
+def save_output(output_dir, filename, value):
+    output_path = os.path.join(output_dir, f"{filename}.json")
+    logging.info(f"Saving results to {output_path}")
+    with open(output_path, "w") as f:
+        json.dump(value, f, indent=2)
+    logging.info("Results have been saved successfully")
+    return output_path
+
+
+def build_pipeline(
+    db_obj,
+    analytics_service,
+    output_dir,
+    cache_dir=None,
+    state_dir=None,
+    sample_rate=None,
+):
+    def retrieve_claims():
+        claims = db_obj.retrieve_claims()
+        logging.info(f"Number of claims retrieved: {len(claims)}")
+        return claims
+
+    def retrieve_claim_columns():
+        claim_columns = db_obj.retrieve_claim_columns()
+        logging.info(f"Number of claims retrieved: {len(claim_columns)}")
+        return claim_columns
+
+    def retrieve_reverts():
+        reverts = db_obj.retrieve_reverts()
+        logging.info(f"Number of reverts retrieved: {len(reverts)}")
+        return reverts
+
+    def build_base_cube(engine_claims, reverts, allowed_npis, pharmacies=[]):
+        if state_dir is None:
+            return analytics_service.build_cube(
+                claims=engine_claims, reverts=reverts, allowed_npis=allowed_npis
+            )
+
+        # This run's cube is a delta over the cube of the previous runs
+        cube_path = os.path.join(state_dir, "cube.json")
+        state = AggregateCube.load(cube_path) if os.path.exists(cube_path) else None
+        claim_index = analytics_service.claim_index
+        claim_index.recover(state.generation if state is not None else 0)
+        scales = (
+            (PRICE_SCALE, QUANTITY_SCALE) if analytics_service.exact_prices else (1, 1)
+        )
+        if state is not None and (state.price_scale, state.quantity_scale) != scales:
+            raise ValueError(
+                f"{cube_path} was built with different price/quantity scales, "
+                "use the same --exact-prices option (and version) as the previous runs"
+            )
+
+        # The claims and reverts of this run are only recorded in the index
+        # once the merged cube is saved, so a failed run can simply be rerun
+        claim_index.begin()
+        try:
+            cube = analytics_service.build_cube(
+                claims=engine_claims, reverts=reverts, allowed_npis=allowed_npis
+            )
+            if state is not None:
+                state.merge(cube)
+                cube = state
+            # The saved cube answers Goal 3 on its own
+            cube.remap_chains(pharmacies)
+            cube.generation += 1
+            claim_index.prepare(cube.generation)
+            cube.save(cube_path)
+        except Exception:
+            claim_index.rollback()
+            raise
+        claim_index.commit()
+        return cube
+
+    def map_chains(base_cube, pharmacies):
+        base_cube.remap_chains(pharmacies)
+        return base_cube
+
+    stages = [
+        # Ingest and validation (records are validated by the models while loading)
+        Stage(
+            "claims",
+            retrieve_claims,
+            fingerprint=lambda: directory_fingerprint(db_obj.claims_dir),
+        ),
+        Stage(
+            "reverts",
+            retrieve_reverts,
+            fingerprint=lambda: directory_fingerprint(db_obj.reverts_dir),
+        ),
+        Stage(
+            "pharmacies",
+            db_obj.retrieve_pharmacies,
+            fingerprint=lambda: directory_fingerprint(db_obj.pharmacies_dir),
+        ),
+        # Claims as the engine works on them, shared by the cube and Goal 4:
+        # columnar engines read them as columnar batches, without building
+        # Claim objects (the claims stage is then only run for Goal 5 and
+        # --sample)
+        (
+            Stage(
+                "engine_claims",
+                retrieve_claim_columns,
+                fingerprint=lambda: directory_fingerprint(db_obj.claims_dir),
+            )
+            if analytics_service.accepts_claim_columns
+            else Stage("engine_claims", lambda claims: claims, inputs=["claims"])
+        ),
+        # Keyed by value: a pharmacies change that keeps the same npis (e.g. a
+        # chain rename) does not invalidate the artifacts built from it
+        Stage(
+            "allowed_npis",
+            lambda pharmacies: sorted({pharmacy.npi for pharmacy in pharmacies}),
+            inputs=["pharmacies"],
+            key_by_value=True,
+        ),
+        # Dedup, revert application and aggregation for Goals 2 and 3. With
+        # state_dir, the merged cube is saved with its chain mapping, so it
+        # also depends on the pharmacies
+        Stage(
+            "base_cube",
+            build_base_cube,
+            inputs=["engine_claims", "reverts", "allowed_npis"]
+            + (["pharmacies"] if state_dir is not None else []),
+            persist=state_dir is None,
+            fingerprint=lambda: f"{type(analytics_service).__name__}:exact_prices={analytics_service.exact_prices}",
+        ),
+        # Chain roll-up, the only part recomputed when npis are remapped to
+        # chains. The persisted cube can answer Goals 2 and 3 on its own.
+        Stage(
+            "cube",
+            map_chains,
+            inputs=["base_cube", "pharmacies"],
+            persist=state_dir is None,
+        ),
+        # Unit price sketches by (npi, ndc) for Goal 5
+        Stage(
+            "price_sketches",
+            lambda claims, reverts, allowed_npis: analytics_service.build_price_sketches(
+                claims=claims, reverts=reverts, allowed_npis=allowed_npis
+            ),
+            inputs=["claims", "reverts", "allowed_npis"],
+            persist=True,
+        ),
+        # Outputs
+        Stage(
+            "metrics",
+            lambda cube: save_output(
+                output_dir, "metrics", analytics_service.metrics_from_cube(cube)
+            ),
+            inputs=["cube"],
+        ),
+        Stage(
+            "drug_recommendation_by_chains",
+            lambda cube: save_output(
+                output_dir,
+                "drug_recommendation_by_chains",
+                analytics_service.drug_recommendation_from_cube(cube),
+            ),
+            inputs=["cube"],
+        ),
+        Stage(
+            "most_prescribed_quantity_by_drug",
+            lambda engine_claims, reverts, allowed_npis: save_output(
+                output_dir,
+                "most_prescribed_quantity_by_drug",
+                analytics_service.most_prescribed_quantity_by_drug(
+                    claims=engine_claims, reverts=reverts, allowed_npis=allowed_npis
+                ),
+            ),
+            inputs=["engine_claims", "reverts", "allowed_npis"],
+        ),
+        Stage(
+            "unit_price_percentiles",
+            lambda price_sketches, pharmacies: save_output(
+                output_dir,
+                "unit_price_percentiles",
+                analytics_service.unit_price_percentiles_from_sketches(
+                    price_sketches, pharmacies
+                ),
+            ),
+            inputs=["price_sketches", "pharmacies"],
+        ),
+    ]
+
+    if sample_rate is not None:
+        sampler = StratifiedSampler(rate=sample_rate)
+        approximate_analytics = ApproximateAnalytics(
+            analytics=type(analytics_service)(
+                exact_prices=analytics_service.exact_prices,
+                quarantine=analytics_service.quarantine,
+            )
+        )
+
+        def draw_sample():
+            # Drawn while reading the files: only the sampled records are validated
+            sample = sampler.sample_database(db_obj)
+            logging.info(
+                f"Number of claims sampled: {len(sample.claims)}, reverts: {len(sample.reverts)}"
+            )
+            return sample
+
+        stages += [
+            Stage(
+                "sample",
+                draw_sample,
+                persist=True,
+                fingerprint=lambda: "\n".join(
+                    [
+                        f"rate={sample_rate}",
+                        directory_fingerprint(db_obj.claims_dir),
+                        directory_fingerprint(db_obj.reverts_dir),
+                    ]
+                ),
+            ),
+            Stage(
+                "metrics_sample",
+                lambda sample, allowed_npis: save_output(
+                    output_dir,
+                    "metrics_sample",
+                    approximate_analytics.compute_metrics(
+                        sample=sample, allowed_npis=allowed_npis
+                    ),
+                ),
+                inputs=["sample", "allowed_npis"],
+            ),
+            Stage(
+                "drug_recommendation_by_chains_sample",
+                lambda sample, pharmacies, allowed_npis: save_output(
+                    output_dir,
+                    "drug_recommendation_by_chains_sample",
+                    approximate_analytics.drug_recommendation_by_chains(
+                        sample=sample,
+                        pharmacies=pharmacies,
+                        allowed_npis=allowed_npis,
+                    ),
+                ),
+                inputs=["sample", "pharmacies", "allowed_npis"],
+            ),
+            Stage(
+                "most_prescribed_quantity_by_drug_sample",
+                lambda sample, allowed_npis: save_output(
+                    output_dir,
+                    "most_prescribed_quantity_by_drug_sample",
+                    approximate_analytics.most_prescribed_quantity_by_drug(
+                        sample=sample, allowed_npis=allowed_npis
+                    ),
+                ),
+                inputs=["sample", "allowed_npis"],
+            ),
+        ]
+    return Pipeline(stages=stages, cache_dir=cache_dir)
+
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Pharmacy Data Project")
     parser.add_argument(
         "--goals",
         nargs="*",
         default=["2", "3", "4"],
-        help="Specify which goals to run (2, 3, and/or 4). By default, all are run.",
+        help="Specify which goals to run (2, 3, 4 and/or 5). By default, goals 2, 3 and 4 are run.",
+    )
+    parser.add_argument(
+        "--exact-prices",
+        action="store_true",
+        help="Accumulate prices and quantities as integer millionths instead of floats.",
+    )
+    parser.add_argument(
+        "--engine",
+        choices=sorted(ENGINES),
+        default="python",
+        help="Analytics implementation to use. By default, the pure Python one.",
+    )
+    parser.add_argument(
+        "--cache-dir",
+        default=None,
+        help="Persist intermediate artifacts in this directory and reuse them in later runs.",
+    )
+    parser.add_argument(
+        "--sample",
+        type=float,
+        default=None,
+        help="Estimate Goals 2, 3 and 4 from a deterministic sample of this fraction of the claims (e.g. 0.01), with error bounds.",
+    )
+    parser.add_argument(
+        "--large-file-mb",
+        type=int,
+        default=256,
+        help="JSON files of at least this size (in MB) are split in chunks parsed in parallel.",
+    )
+    parser.add_argument(
+        "--parse-workers",
+        type=int,
+        default=None,
+        help="Number of processes parsing the chunks of a large file. By default, one per CPU.",
+    )
+    parser.add_argument(
+        "--state-dir",
+        default=None,
+        help="Keep an index of processed claims and the aggregates of previous runs in this directory, so each run only needs the new files (Goals 2 and 3).",
     )
     args = parser.parse_args()
 
-    # Determine which goals to run
-    run_goal_2 = "2" in args.goals
-    run_goal_3 = "3" in args.goals
-    run_goal_4 = "4" in args.goals
-
     logging.info("Initializing script...")
-    output_file_list = []
     current_dir = os.path.dirname(os.path.abspath(__file__))
     project_root = os.path.abspath(os.path.join(current_dir, ".."))
     claims_dir = os.path.join(project_root, "data", "claims")
@@ -43,61 +354,45 @@ if __name__ == "__main__":
     if not os.path.exists(output_dir):
         os.makedirs(output_dir)
 
-    db_obj = Database(
-        claims_dir=claims_dir, reverts_dir=reverts_dir, pharmacies_dir=pharmacies_dir
+    # Rejected records of this run are written to data/quarantine, in a file
+    # named after a unique run id
+    quarantine = QuarantineSink(
+        quarantine_dir=os.path.join(project_root, "data", "quarantine")
     )
 
-    claims = db_obj.retrieve_claims()
-    logging.info(f"Number of claims retrieved: {len(claims)}")
-    reverts = db_obj.retrieve_reverts()
-    logging.info(f"Number of reverts retrieved: {len(reverts)}")
-    pharmacies = db_obj.retrieve_pharmacies()
-    npis_list = [pharmacy.npi for pharmacy in pharmacies]
-
-    analytics_service = AnalyticsService()
-
-    # Goal 2: Compute metrics
-    if run_goal_2:
-        metrics = analytics_service.compute_metrics(
-            claims=claims,
-            reverts=reverts,
-            allowed_npis=npis_list,
-        )
-        output_file_list.append({"filename": "metrics", "value": metrics})
-
-    # Goal 3: Drug recommendation by chains
-    if run_goal_3:
-        drug_recommendation_by_chains = analytics_service.drug_recommendation_by_chains(
-            claims=claims,
-            reverts=reverts,
-            pharmacies=pharmacies,
-            allowed_npis=npis_list,
-        )
-        output_file_list.append(
-            {
-                "filename": "drug_recommendation_by_chains",
-                "value": drug_recommendation_by_chains,
-            }
-        )
-
-    # Goal 4: Most prescribed quantity by drug
-    if run_goal_4:
-        most_prescribed_quantity_by_drug = (
-            analytics_service.most_prescribed_quantity_by_drug(
-                claims=claims, reverts=reverts, allowed_npis=npis_list
-            )
-        )
-        output_file_list.append(
-            {
-                "filename": "most_prescribed_quantity_by_drug",
-                "value": most_prescribed_quantity_by_drug,
-            }
-        )
+    db_obj = Database(
+        claims_dir=claims_dir,
+        reverts_dir=reverts_dir,
+        pharmacies_dir=pharmacies_dir,
+        quarantine=quarantine,
+        large_file_threshold=args.large_file_mb * 1024 * 1024,
+        parse_workers=args.parse_workers,
+    )
+    claim_index = None
+    if args.state_dir is not None:
+        os.makedirs(args.state_dir, exist_ok=True)
+        claim_index = ClaimIndex(os.path.join(args.state_dir, "claim_index.bin"))
+    analytics_service = ENGINES[args.engine](
+        exact_prices=args.exact_prices,
+        claim_index=claim_index,
+        quarantine=quarantine,
+    )
 
-    # Save results to data/outputs
-    for result in output_file_list:
-        output_path = os.path.join(output_dir, f"{result['filename']}.json")
-        logging.info(f"Saving results to {output_path}")
-        with open(output_path, "w") as f:
-            json.dump(result["value"], f, indent=2)
-        logging.info("Results have been saved successfully")
+    pipeline = build_pipeline(
+        db_obj=db_obj,
+        analytics_service=analytics_service,
+        output_dir=output_dir,
+        cache_dir=args.cache_dir,
+        state_dir=args.state_dir,
+        sample_rate=args.sample,
+    )
+    targets = []
+    for goal in args.goals:
+        if args.sample is not None and goal in SAMPLE_GOAL_STAGES:
+            targets.append(SAMPLE_GOAL_STAGES[goal])
+        elif goal in GOAL_STAGES:
+            targets.append(GOAL_STAGES[goal])
+    pipeline.run(targets=targets)
+    quarantine.close()
+    if claim_index is not None:
+        claim_index.close()
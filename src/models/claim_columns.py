@@ -0,0 +1,47 @@
+import numpy as np
+from dataclasses import dataclass, fields
+from src.models.claim import Claim
+from typing import List
+
+
+@dataclass
+class ClaimColumns:
+    """Columnar batch of claims (one NumPy array per field)"""
+
+    id: np.ndarray
+    npi: np.ndarray
+    ndc: np.ndarray
+    price: np.ndarray
+    quantity: np.ndarray
+
+    @classmethod
+    def from_claims(cls, claims: List[Claim]) -> "ClaimColumns":
+        return cls(
+            id=np.array([claim.id for claim in claims], dtype=str),
+            npi=np.array([claim.npi for claim in claims], dtype=str),
+            ndc=np.array([claim.ndc for claim in claims], dtype=str),
+            price=np.fromiter(
+                (claim.price for claim in claims), dtype=np.float64, count=len(claims)
+            ),
+            quantity=np.fromiter(
+                (claim.quantity for claim in claims),
+                dtype=np.float64,
+                count=len(claims),
+            ),
+        )
+
+    @classmethod
+    def concatenate(cls, batches: List["ClaimColumns"]) -> "ClaimColumns":
+        if not batches:
+            return cls.from_claims([])
+        return cls(
+            **{
+                field.name: np.concatenate(
+                    [getattr(batch, field.name) for batch in batches]
+                )
+                for field in fields(cls)
+            }
+        )
+
+    def __len__(self) -> int:
+        return len(self.id)
@@ -0,0 +1,219 @@
+import hashlib
+import logging
+import os
+import pickle
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Dict, List, Optional
+
+
+def directory_fingerprint(path: str) -> str:
+    """Fingerprint of a data directory based on file names, sizes and mtimes"""
+    entries = []
+    for filename in sorted(os.listdir(path)):
+        stat = os.stat(os.path.join(path, filename))
+        entries.append(f"{filename}:{stat.st_size}:{stat.st_mtime_ns}")
+    return "|".join(entries)
+
+
+class Stage:
+    """
+    A pipeline step producing one named artifact.
+
+    - func: called with one keyword argument per declared input
+    - inputs: names of the stages whose artifacts this stage consumes
+    - persist: store the artifact in the pipeline cache so later runs can reuse it
+    - fingerprint: returns a string identifying the stage's own external state
+      (source files, options). It is combined with the inputs' keys to build
+      the cache key.
+    - key_by_value: the cache key is a digest of the artifact instead, so the
+      stages consuming it are only invalidated when its value changes. The
+      stage (and its inputs) is always run, and the stages consuming it are
+      looked up in the cache once it has. It cannot be persisted.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        func: Callable[..., Any],
+        inputs: List[str] = [],
+        persist: bool = False,
+        fingerprint: Optional[Callable[[], str]] = None,
+        key_by_value: bool = False,
+    ) -> None:
+        if persist and key_by_value:
+            raise ValueError(f"Stage {name} keyed by value cannot be persisted")
+        self.name = name
+        self.func = func
+        self.inputs = list(inputs)
+        self.persist = persist
+        self.fingerprint = fingerprint
+        self.key_by_value = key_by_value
+
+
+class Pipeline:
+    """
+    Runs stages as soon as their inputs are available, so independent stages
+    run concurrently. Stages share artifacts in memory, so they are run in
+    threads rather than processes: only the stages releasing the GIL (I/O,
+    numpy, worker processes such as the JSONDatabase parsers) overlap.
+    """
+
+    def __init__(
+        self,
+        stages: List[Stage],
+        cache_dir: Optional[str] = None,
+        max_workers: int = 4,
+    ) -> None:
+        self.stages = {}
+        for stage in stages:
+            if stage.name in self.stages:
+                raise ValueError(f"Duplicated stage {stage.name}")
+            self.stages[stage.name] = stage
+        for stage in stages:
+            for input_name in stage.inputs:
+                if input_name not in self.stages:
+                    raise ValueError(
+                        f"Stage {stage.name} depends on unknown stage {input_name}"
+                    )
+        self.cache_dir = cache_dir
+        self.max_workers = max_workers
+        self.__keys = {}
+        self.__fingerprints = {}
+
+    def __check_cycles(self, name: str, checked: set, visiting=()) -> None:
+        if name in visiting:
+            raise ValueError(f"Cycle detected at stage {name}")
+        if name in checked:
+            return
+        if name not in self.stages:
+            raise ValueError(f"Unknown stage {name}")
+        for input_name in self.stages[name].inputs:
+            self.__check_cycles(input_name, checked, visiting + (name,))
+        checked.add(name)
+
+    def __cache_key(self, name: str, artifacts: Dict[str, Any]) -> Optional[str]:
+        """
+        Cache key of a stage, or None while it depends on a stage keyed by value
+        that has not run yet
+        """
+        if name in self.__keys:
+            return self.__keys[name]
+
+        stage = self.stages[name]
+        digest = hashlib.sha256(name.encode())
+        if stage.key_by_value:
+            if name not in artifacts:
+                return None
+            digest.update(pickle.dumps(artifacts[name]))
+        else:
+            if stage.fingerprint is not None:
+                if name not in self.__fingerprints:
+                    self.__fingerprints[name] = stage.fingerprint()
+                digest.update(self.__fingerprints[name].encode())
+            for input_name in stage.inputs:
+                input_key = self.__cache_key(input_name, artifacts)
+                if input_key is None:
+                    return None
+                digest.update(input_key.encode())
+        self.__keys[name] = digest.hexdigest()[:16]
+        return self.__keys[name]
+
+    def __cache_path(self, name: str) -> str:
+        return os.path.join(self.cache_dir, f"{name}-{self.__keys[name]}.pkl")
+
+    def __is_persisted(self, name: str) -> bool:
+        return self.cache_dir is not None and self.stages[name].persist
+
+    def __is_cached(self, name: str, artifacts: Dict[str, Any]) -> bool:
+        return (
+            self.__is_persisted(name)
+            and self.__cache_key(name, artifacts) is not None
+            and os.path.exists(self.__cache_path(name))
+        )
+
+    def __required_stages(
+        self, targets: List[str], artifacts: Dict[str, Any]
+    ) -> List[str]:
+        """
+        Targets and their transitive inputs, skipping inputs of cached stages.
+        Until the key of a persisted stage is known, only the inputs needed to
+        compute it are required.
+        """
+        required = []
+        pending = list(targets)
+        while pending:
+            name = pending.pop()
+            if name in required:
+                continue
+            required.append(name)
+            if name in artifacts or self.__is_cached(name, artifacts):
+                continue
+            inputs = self.stages[name].inputs
+            if self.__is_persisted(name) and self.__cache_key(name, artifacts) is None:
+                inputs = [
+                    input_name
+                    for input_name in inputs
+                    if self.__cache_key(input_name, artifacts) is None
+                ]
+            pending.extend(inputs)
+        return required
+
+    def __run_stage(self, name: str, inputs: Dict[str, Any], cached: bool) -> Any:
+        stage = self.stages[name]
+        if cached:
+            logging.info(f"Reusing persisted artifact for stage {name}")
+            with open(self.__cache_path(name), "rb") as f:
+                return pickle.load(f)
+
+        logging.info(f"Running stage {name}")
+        artifact = stage.func(**inputs)
+        if self.__is_persisted(name):
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(self.__cache_path(name), "wb") as f:
+                pickle.dump(artifact, f)
+        return artifact
+
+    def run(self, targets: Optional[List[str]] = None) -> Dict[str, Any]:
+        """Run the given stages (all of them by default) and return their artifacts"""
+        self.__keys = {}
+        self.__fingerprints = {}
+        if targets is None:
+            targets = list(self.stages)
+        checked = set()
+        for name in targets:
+            self.__check_cycles(name, checked)
+
+        artifacts = {}
+        running = {}
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while True:
+                # Stages keyed by value that have run can make cached stages
+                # (and their inputs) unnecessary, so this is recomputed
+                required = self.__required_stages(targets, artifacts)
+                if all(name in artifacts for name in required):
+                    break
+                for name in required:
+                    if name in artifacts or name in running.values():
+                        continue
+                    cached = self.__is_cached(name, artifacts)
+                    if cached:
+                        inputs = {}
+                    elif all(
+                        input_name in artifacts
+                        for input_name in self.stages[name].inputs
+                    ):
+                        inputs = {
+                            input_name: artifacts[input_name]
+                            for input_name in self.stages[name].inputs
+                        }
+                    else:
+                        continue
+                    future = executor.submit(self.__run_stage, name, inputs, cached)
+                    running[future] = name
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    name = running.pop(future)
+                    artifacts[name] = future.result()
+
+        return {name: artifacts[name] for name in targets}
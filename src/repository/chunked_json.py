@@ -0,0 +1,149 @@
+import json
+import mmap
+import os
+import re
+import numpy as np
+from collections import Counter
+from datetime import datetime
+from pydantic import BaseModel
+from .quarantine import error_type
+from typing import Callable, Dict, List, Optional, Tuple, Type
+
+# End of a record, separator and start of the next one. Records are flat JSON
+# objects, so a closing brace followed by a comma and an opening brace is a
+# record boundary, unless it is inside a string value.
+RECORD_BOUNDARY = re.compile(rb"}\s*,\s*{")
+# Backslashes before a double quote: the quote is escaped if there is an odd
+# number of them
+ESCAPE_RUN = re.compile(rb'(\\+)"')
+
+
+def count_string_quotes(data: bytes) -> int:
+    """Number of double quotes delimiting JSON strings (not escaped) in data"""
+    escaped = sum(1 for run in ESCAPE_RUN.findall(data) if len(run) % 2 == 1)
+    return data.count(b'"') - escaped
+
+
+def chunk_ranges(filepath: str, chunk_size: int) -> List[Tuple[int, int]]:
+    """
+    Split the records of a JSON array file into byte ranges of about
+    chunk_size bytes, each range starting and ending on a record boundary
+    """
+    with open(filepath, "rb") as f, mmap.mmap(
+        f.fileno(), 0, access=mmap.ACCESS_READ
+    ) as mm:
+        start = mm.find(b"[") + 1
+        end = mm.rfind(b"]")
+        if start <= 0 or end < start:
+            raise ValueError(f"{filepath} does not contain a JSON array")
+
+        ranges = []
+        range_start = start
+        # Quotes are counted from a position known to be outside any string,
+        # so a boundary candidate is inside a string when the count is odd
+        scanned, quotes = start, 0
+        while end - range_start > chunk_size:
+            match = RECORD_BOUNDARY.search(mm, range_start + chunk_size, end)
+            while match is not None:
+                quotes += count_string_quotes(mm[scanned : match.start()])
+                scanned = match.start()
+                if quotes % 2 == 0:
+                    break
+                match = RECORD_BOUNDARY.search(mm, match.start() + 1, end)
+            if match is None:
+                break
+            ranges.append((range_start, match.start() + 1))
+            range_start = match.end() - 1
+        ranges.append((range_start, end))
+        return ranges
+
+
+def count_field_values(filepath: str, field: str) -> Counter:
+    """
+    Count the string values of a field in a JSON array file of flat records,
+    scanning the raw bytes instead of parsing the records
+    """
+    if os.path.getsize(filepath) == 0:
+        return Counter()
+    pattern = re.compile(
+        rb'"' + re.escape(field.encode()) + rb'"\s*:\s*"((?:[^"\\]|\\.)*)"'
+    )
+    with open(filepath, "rb") as f, mmap.mmap(
+        f.fileno(), 0, access=mmap.ACCESS_READ
+    ) as mm:
+        return Counter(unescape(match.group(1)) for match in pattern.finditer(mm))
+
+
+def unescape(raw: bytes) -> str:
+    """The value of the raw bytes of a JSON string, between its quotes"""
+    if b"\\" not in raw:
+        return raw.decode()
+    return json.loads(b'"' + raw + b'"')
+
+
+def column_types(model: Type[BaseModel]) -> Dict[str, type]:
+    return {name: field.annotation for name, field in model.model_fields.items()}
+
+
+def parse_chunk(
+    filepath: str,
+    start: int,
+    end: int,
+    model: Type[BaseModel],
+    record_filter: Optional[Callable[[object], bool]] = None,
+) -> Tuple[Dict[str, np.ndarray], List[Tuple[int, object, str]], int]:
+    """
+    Parse and validate the records in a byte range of a JSON array file.
+    Records for which record_filter returns False are skipped without being
+    validated.
+
+    Returns (columns, rejected, record count): one NumPy array per model field
+    for the valid records (datetimes as ISO strings) and (offset in the chunk,
+    record, error type) for the rejected ones.
+    """
+    with open(filepath, "rb") as f, mmap.mmap(
+        f.fileno(), 0, access=mmap.ACCESS_READ
+    ) as mm:
+        records = json.loads(b"[" + mm[start:end] + b"]")
+
+    types = column_types(model)
+    values = {name: [] for name in types}
+    rejected = []
+    for offset, record in enumerate(records):
+        if record_filter is not None and not record_filter(record):
+            continue
+        try:
+            item = model(**record)
+        except Exception as ex:
+            rejected.append((offset, record, error_type(ex)))
+            continue
+        for name in types:
+            values[name].append(getattr(item, name))
+
+    columns = {}
+    for name, annotation in types.items():
+        if annotation is float:
+            columns[name] = np.array(values[name], dtype=np.float64)
+        elif annotation is datetime:
+            columns[name] = np.array(
+                [value.isoformat() for value in values[name]], dtype=str
+            )
+        else:
+            columns[name] = np.array(values[name], dtype=str)
+    return columns, rejected, len(records)
+
+
+def models_from_columns(
+    columns: Dict[str, np.ndarray], model: Type[BaseModel]
+) -> List[BaseModel]:
+    """Rebuild already validated models from the columns returned by parse_chunk"""
+    types = column_types(model)
+    fields = {}
+    for name, annotation in types.items():
+        fields[name] = columns[name].tolist()
+        if annotation is datetime:
+            fields[name] = [datetime.fromisoformat(value) for value in fields[name]]
+    return [
+        model.model_construct(**dict(zip(types, row)))
+        for row in zip(*(fields[name] for name in types))
+    ]
@@ -0,0 +1,297 @@
+import hashlib
+import logging
+import os
+import numpy as np
+from typing import NamedTuple, Optional, Tuple
+
+MAGIC = b"CLMIDX01"
+HEADER = np.dtype([("magic", "S8"), ("capacity", "<u8"), ("count", "<u8")])
+SLOT = np.dtype(
+    [
+        ("used", "u1"),
+        ("reverted", "u1"),
+        ("key_low", "<u8"),
+        ("key_high", "<u8"),
+        ("npi", "S20"),
+        ("ndc", "S20"),
+        ("price", "<f8"),
+        ("quantity", "<f8"),
+    ]
+)
+
+
+class IndexedClaim(NamedTuple):
+    npi: str
+    ndc: str
+    price: float
+    quantity: float
+
+
+class ClaimIndex:
+    """
+    Persistent hash index from claim id to (npi, ndc, price, quantity).
+
+    The index is an open addressing hash table (linear probing) stored in a
+    memory-mapped file, keyed by a 128 bits digest of the claim id. It only
+    grows: claims are appended as they are ingested, and a claim can be
+    marked as reverted so the revert is applied once across runs. The table
+    is rebuilt with twice the capacity when it is more than max_load full.
+
+    Changes are written to the file right away, unless a transaction is
+    open (begin): they are then kept in memory until commit, so the index
+    can be kept in sync with the aggregates saved by a run:
+    - prepare(generation) writes the pending changes to a journal file,
+    - commit() applies them to the index and removes the journal,
+    - recover(generation) completes the journal of an interrupted run if its
+      aggregates were saved with that generation, or discards it otherwise.
+    """
+
+    def __init__(
+        self, path: str, initial_capacity: int = 1024, max_load: float = 0.7
+    ) -> None:
+        self.path = path
+        self.journal_path = path + ".journal"
+        self.max_load = max_load
+        self.__pending = None  # (adds: key -> slot values, reverted keys)
+        if not os.path.exists(path):
+            self.__create(path, initial_capacity)
+        self.__open()
+
+    @staticmethod
+    def __create(path: str, capacity: int):
+        header = np.zeros(1, dtype=HEADER)
+        header["magic"] = MAGIC
+        header["capacity"] = capacity
+        with open(path, "wb") as f:
+            f.write(header.tobytes())
+            f.truncate(HEADER.itemsize + capacity * SLOT.itemsize)
+
+    def __open(self):
+        self.__header = np.memmap(self.path, dtype=HEADER, mode="r+", shape=(1,))
+        if self.__header["magic"][0] != MAGIC:
+            raise ValueError(f"{self.path} is not a claim index file")
+        self.capacity = int(self.__header["capacity"][0])
+        self.__slots = np.memmap(
+            self.path,
+            dtype=SLOT,
+            mode="r+",
+            offset=HEADER.itemsize,
+            shape=(self.capacity,),
+        )
+
+    def __len__(self) -> int:
+        count = int(self.__header["count"][0])
+        if self.__pending is not None:
+            count += len(self.__pending[0])
+        return count
+
+    @staticmethod
+    def fits(npi: str, ndc: str) -> bool:
+        """Whether the npi and ndc of a claim are short enough to be indexed"""
+        return (
+            len(npi.encode()) <= SLOT["npi"].itemsize
+            and len(ndc.encode()) <= SLOT["ndc"].itemsize
+        )
+
+    @staticmethod
+    def __key(claim_id: str) -> Tuple[int, int]:
+        digest = hashlib.blake2b(claim_id.encode(), digest_size=16).digest()
+        return (
+            int.from_bytes(digest[:8], "little"),
+            int.from_bytes(digest[8:], "little"),
+        )
+
+    def __find(self, key: Tuple[int, int]) -> int:
+        """Slot holding the key, or the empty slot where it would be inserted"""
+        slots = self.__slots
+        slot = key[0] % self.capacity
+        while slots[slot]["used"] and (
+            slots[slot]["key_low"] != key[0] or slots[slot]["key_high"] != key[1]
+        ):
+            slot = (slot + 1) % self.capacity
+        return slot
+
+    def __grow(self, needed: int = 1):
+        old_slots = self.__slots[self.__slots["used"] == 1].copy()
+        self.close()
+        tmp_path = self.path + ".tmp"
+        capacity = self.capacity * 2
+        while len(old_slots) + needed > capacity * self.max_load:
+            capacity *= 2
+        self.__create(tmp_path, capacity)
+        os.replace(tmp_path, self.path)
+        self.__open()
+        for entry in old_slots:
+            key = (int(entry["key_low"]), int(entry["key_high"]))
+            self.__slots[self.__find(key)] = entry
+        self.__header["count"] = len(old_slots)
+
+    @staticmethod
+    def __indexed_claim(entry) -> IndexedClaim:
+        return IndexedClaim(
+            npi=entry["npi"].decode(),
+            ndc=entry["ndc"].decode(),
+            price=float(entry["price"]),
+            quantity=float(entry["quantity"]),
+        )
+
+    def get(self, claim_id: str) -> Optional[IndexedClaim]:
+        key = self.__key(claim_id)
+        if self.__pending is not None and key in self.__pending[0]:
+            return self.__indexed_claim(self.__pending[0][key])
+        entry = self.__slots[self.__find(key)]
+        if not entry["used"]:
+            return None
+        return self.__indexed_claim(entry)
+
+    def __contains__(self, claim_id: str) -> bool:
+        return self.get(claim_id) is not None
+
+    def add(
+        self, claim_id: str, npi: str, ndc: str, price: float, quantity: float
+    ) -> bool:
+        """Add a claim, returning False if its id is already indexed"""
+        if not self.fits(npi, ndc):
+            raise ValueError(f"npi/ndc of claim {claim_id} are too long to be indexed")
+
+        key = self.__key(claim_id)
+        values = {
+            "npi": npi.encode(),
+            "ndc": ndc.encode(),
+            "price": price,
+            "quantity": quantity,
+            "reverted": 0,
+        }
+        if self.__pending is not None:
+            if key in self.__pending[0] or self.__slots[self.__find(key)]["used"]:
+                return False
+            self.__pending[0][key] = values
+            return True
+
+        if len(self) + 1 > self.capacity * self.max_load:
+            self.__grow()
+        return self.__insert(key, values)
+
+    def __insert(self, key: Tuple[int, int], values) -> bool:
+        slot = self.__find(key)
+        if self.__slots[slot]["used"]:
+            return False
+        self.__slots[slot] = (
+            1,
+            values["reverted"],
+            *key,
+            values["npi"],
+            values["ndc"],
+            values["price"],
+            values["quantity"],
+        )
+        self.__header["count"] += 1
+        return True
+
+    def mark_reverted(self, claim_id: str) -> Optional[IndexedClaim]:
+        """
+        Mark an indexed claim as reverted, returning it. Returns None if the
+        claim is unknown or was already reverted.
+        """
+        key = self.__key(claim_id)
+        if self.__pending is not None:
+            pending_adds, pending_reverts = self.__pending
+            if key in pending_adds:
+                entry = pending_adds[key]
+            elif key in pending_reverts:
+                return None
+            else:
+                entry = self.__slots[self.__find(key)]
+                if not entry["used"]:
+                    return None
+                entry = {field: entry[field] for field in entry.dtype.names}
+                pending_reverts.add(key)
+        else:
+            entry = self.__slots[self.__find(key)]
+            if not entry["used"]:
+                return None
+        if entry["reverted"]:
+            return None
+        entry["reverted"] = 1
+        return self.__indexed_claim(entry)
+
+    def begin(self):
+        """Keep the following changes in memory until commit or rollback"""
+        if self.__pending is not None:
+            raise ValueError("A claim index transaction is already open")
+        self.__pending = ({}, set())
+
+    def prepare(self, generation: int):
+        """Write the pending changes to the journal, tagged with generation"""
+        pending_adds, pending_reverts = self.__pending
+        adds = np.zeros(len(pending_adds), dtype=SLOT)
+        for i, (key, values) in enumerate(pending_adds.items()):
+            adds[i] = (
+                1,
+                values["reverted"],
+                *key,
+                values["npi"],
+                values["ndc"],
+                values["price"],
+                values["quantity"],
+            )
+        reverts = np.array(sorted(pending_reverts), dtype="<u8").reshape(-1, 2)
+        tmp_path = self.journal_path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, generation=generation, adds=adds, reverts=reverts)
+        os.replace(tmp_path, self.journal_path)
+
+    def commit(self):
+        """Apply the prepared changes to the index"""
+        self.__pending = None
+        self.__apply_journal()
+
+    def rollback(self):
+        """Discard the pending and prepared changes"""
+        self.__pending = None
+        if os.path.exists(self.journal_path):
+            os.remove(self.journal_path)
+
+    def recover(self, generation: int):
+        """
+        Apply the journal left by an interrupted commit if it was prepared
+        for generation (the generation of the last saved aggregates), or
+        discard it if those aggregates were never saved
+        """
+        if not os.path.exists(self.journal_path):
+            return
+        with np.load(self.journal_path) as journal:
+            journal_generation = int(journal["generation"])
+        if journal_generation == generation:
+            logging.info(f"Completing the interrupted commit of {self.path}")
+            self.__apply_journal()
+        else:
+            logging.info(f"Discarding the uncommitted changes of {self.path}")
+            self.rollback()
+
+    def __apply_journal(self):
+        # Idempotent, so an interrupted apply can be replayed
+        with np.load(self.journal_path) as journal:
+            adds, reverts = journal["adds"], journal["reverts"]
+        if len(self) + len(adds) > self.capacity * self.max_load:
+            self.__grow(len(adds))
+        for entry in adds:
+            key = (int(entry["key_low"]), int(entry["key_high"]))
+            values = {field: entry[field] for field in entry.dtype.names}
+            if not self.__insert(key, values) and values["reverted"]:
+                self.__slots[self.__find(key)]["reverted"] = 1
+        for key_low, key_high in reverts.tolist():
+            slot = self.__find((key_low, key_high))
+            if self.__slots[slot]["used"]:
+                self.__slots[slot]["reverted"] = 1
+        self.flush()
+        os.remove(self.journal_path)
+
+    def flush(self):
+        self.__slots.flush()
+        self.__header.flush()
+
+    def close(self):
+        self.flush()
+        del self.__slots
+        del self.__header
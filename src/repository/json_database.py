@@ -1,55 +1,158 @@
 import csv
-import json
+import logging
 import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
 from .db_interface import DatabaseInterface
+from .quarantine import QuarantineSink
+from .chunked_json import (
+    chunk_ranges,
+    count_field_values,
+    models_from_columns,
+    parse_chunk,
+)
+from collections import Counter
 from src.models.claim import Claim
+from src.models.claim_columns import ClaimColumns
 from src.models.revert import Revert
 from src.models.pharmacy import Pharmacy
-from typing import List
-import logging
+from pydantic import BaseModel
+from typing import Callable, Dict, Iterator, List, Optional, Type
+import numpy as np
 
 
 class JSONDatabase(DatabaseInterface):
-    def __init__(self, claims_dir: str, reverts_dir: str, pharmacies_dir: str):
+    def __init__(
+        self,
+        claims_dir: str,
+        reverts_dir: str,
+        pharmacies_dir: str,
+        quarantine: Optional[QuarantineSink] = None,
+        large_file_threshold: int = 256 * 1024 * 1024,
+        chunk_size: int = 64 * 1024 * 1024,
+        parse_workers: Optional[int] = None,
+    ):
+        """
+        JSON files are parsed and validated in parallel by parse_workers
+        processes (by default, one per CPU). Files of at least
+        large_file_threshold bytes are split into chunks of about chunk_size
+        bytes.
+
+        A rejected record is quarantined once, however many times its file is
+        read (e.g. claims read both as models and as columns, or both sampled
+        and in full).
+
+        The retrieve methods take an optional record_filter, called with each
+        raw JSON record: records it returns False for are skipped before being
+        validated (and so never quarantined).
+        """
         self.claims_dir = claims_dir
         self.reverts_dir = reverts_dir
         self.pharmacies_dir = pharmacies_dir
+        # Rejected records are sent to the quarantine sink
+        self.quarantine = quarantine if quarantine is not None else QuarantineSink()
+        self.large_file_threshold = large_file_threshold
+        self.chunk_size = chunk_size
+        self.parse_workers = parse_workers
+        self.__reported = set()  # (filepath, offset) of the quarantined records
+        self.__reported_lock = threading.Lock()
 
-    def retrieve_claims(self) -> List[Claim]:
-        claims = []
-        for filename in os.listdir(self.claims_dir):
+    def __json_files(self, directory: str) -> Iterator[str]:
+        for filename in os.listdir(directory):
             if filename.endswith(".json"):
-                filepath = os.path.join(self.claims_dir, filename)
-                with open(filepath, "r") as f:
-                    data = json.load(f)
-                    for record in data:
-                        try:
-                            claim = Claim(**record)
-                            claims.append(claim)
-                        except Exception as ex:
-                            logging.warning(
-                                "Fail to process record %s from file %s due to %s"
-                                % (record, filepath, str(ex))
-                            )
-        return claims
+                yield os.path.join(directory, filename)
 
-    def retrieve_reverts(self) -> List[Revert]:
-        reverts = []
-        for filename in os.listdir(self.reverts_dir):
-            if filename.endswith(".json"):
-                filepath = os.path.join(self.reverts_dir, filename)
-                with open(filepath, "r") as f:
-                    data = json.load(f)
-                    for record in data:
-                        try:
-                            revert = Revert(**record)
-                            reverts.append(revert)
-                        except Exception as ex:
-                            logging.warning(
-                                "Fail to process record %s from file %s due to %s"
-                                % (record, filepath, str(ex))
-                            )
-        return reverts
+    def __is_large(self, filepath: str) -> bool:
+        return os.path.getsize(filepath) >= self.large_file_threshold
+
+    def __reject(self, record, error, filepath: str, offset: int):
+        with self.__reported_lock:
+            if (filepath, offset) in self.__reported:
+                return
+            self.__reported.add((filepath, offset))
+        self.quarantine.reject(record, error, filepath, offset)
+
+    def __parse_files(
+        self, directory: str, model: Type[BaseModel], record_filter=None
+    ) -> Iterator[Dict[str, np.ndarray]]:
+        """
+        Columnar batches of the valid records of the JSON files of a directory,
+        in file order. Each small file is one batch; large files are split in
+        chunks. All of them are parsed and validated in worker processes, so
+        parsing does not hold the GIL of the pipeline's threads.
+        """
+        tasks = []  # (filepath, start, end)
+        for filepath in self.__json_files(directory):
+            if self.__is_large(filepath):
+                ranges = chunk_ranges(filepath, self.chunk_size)
+                logging.info(f"Parsing {filepath} in {len(ranges)} chunks")
+            else:
+                ranges = chunk_ranges(filepath, os.path.getsize(filepath))
+            tasks.extend((filepath, start, end) for start, end in ranges)
+        if not tasks:
+            return
+
+        records_before = Counter()  # filepath -> records of its previous chunks
+        with ProcessPoolExecutor(
+            max_workers=min(self.parse_workers or os.cpu_count(), len(tasks))
+        ) as executor:
+            results = executor.map(
+                parse_chunk,
+                [filepath for filepath, _, _ in tasks],
+                [start for _, start, _ in tasks],
+                [end for _, _, end in tasks],
+                repeat(model),
+                repeat(record_filter),
+            )
+            for (filepath, _, _), (columns, rejected, count) in zip(tasks, results):
+                for offset, record, reason in rejected:
+                    self.__reject(
+                        record, reason, filepath, records_before[filepath] + offset
+                    )
+                records_before[filepath] += count
+                yield columns
+
+    def __retrieve(
+        self, directory: str, model: Type[BaseModel], record_filter=None
+    ) -> List:
+        items = []
+        for columns in self.__parse_files(directory, model, record_filter):
+            items.extend(models_from_columns(columns, model))
+        self.quarantine.flush()
+        return items
+
+    def retrieve_claims(
+        self, record_filter: Optional[Callable[[object], bool]] = None
+    ) -> List[Claim]:
+        return self.__retrieve(self.claims_dir, Claim, record_filter)
+
+    def count_claims_by(self, field: str) -> Counter:
+        """Number of raw claim records per value of a string field, without validating them"""
+        counts = Counter()
+        for filepath in self.__json_files(self.claims_dir):
+            counts.update(count_field_values(filepath, field))
+        return counts
+
+    def retrieve_claim_columns(self) -> ClaimColumns:
+        """Claims as a columnar batch, without building Claim objects"""
+        batches = [
+            ClaimColumns(
+                id=columns["id"],
+                npi=columns["npi"],
+                ndc=columns["ndc"],
+                price=columns["price"],
+                quantity=columns["quantity"],
+            )
+            for columns in self.__parse_files(self.claims_dir, Claim)
+        ]
+        self.quarantine.flush()
+        return ClaimColumns.concatenate(batches)
+
+    def retrieve_reverts(
+        self, record_filter: Optional[Callable[[object], bool]] = None
+    ) -> List[Revert]:
+        return self.__retrieve(self.reverts_dir, Revert, record_filter)
 
     def retrieve_pharmacies(self) -> List[Pharmacy]:
         pharmacies = []
@@ -59,15 +162,13 @@ class JSONDatabase(DatabaseInterface):
 
                 with open(filepath, "r") as csv_file:
                     reader = csv.DictReader(csv_file)
-                    for row in reader:
+                    for offset, row in enumerate(reader):
                         try:
                             pharmacy = Pharmacy(
                                 chain=row["chain"].replace(" ", ""), npi=row["npi"]
                             )
                             pharmacies.append(pharmacy)
                         except Exception as ex:
-                            logging.warning(
-                                "Fail to process pharmacy record %s from file %s due to %s"
-                                % (row, filepath, str(ex))
-                            )
+                            self.quarantine.reject(row, ex, filepath, offset)
+        self.quarantine.flush()
         return pharmacies
@@ -0,0 +1,129 @@
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import Counter
+from datetime import datetime
+from pydantic import ValidationError
+from typing import Any, Optional, Union
+
+
+def error_type(ex: Exception) -> str:
+    """Short, low-cardinality description of why a record was rejected"""
+    if isinstance(ex, ValidationError):
+        error = ex.errors(include_url=False, include_input=False)[0]
+        location = ".".join(str(part) for part in error["loc"])
+        return f"{error['type']}:{location}" if location else error["type"]
+    return type(ex).__name__
+
+
+def new_run_id() -> str:
+    """Sortable and unique run id: start time followed by a random suffix"""
+    return f"{datetime.now():%Y%m%dT%H%M%S}-{uuid.uuid4().hex[:8]}"
+
+
+class QuarantineSink:
+    """
+    Collects rejected records.
+
+    - Records are written in batches to quarantine-<run_id>.ndjson inside
+      quarantine_dir, with the error reason, source file and offset
+      (position of the record in its file). Nothing is written when
+      quarantine_dir is None.
+    - A counter is kept per error type.
+    - At most max_logs_per_interval rejections per error type are logged every
+      log_interval seconds; the others are only counted.
+    """
+
+    def __init__(
+        self,
+        quarantine_dir: Optional[str] = None,
+        run_id: Optional[str] = None,
+        batch_size: int = 1000,
+        max_logs_per_interval: int = 5,
+        log_interval: float = 60.0,
+    ) -> None:
+        self.quarantine_dir = quarantine_dir
+        self.run_id = run_id or new_run_id()
+        self.batch_size = batch_size
+        self.max_logs_per_interval = max_logs_per_interval
+        self.log_interval = log_interval
+        self.counters = Counter()
+        self.__buffer = []
+        self.__log_windows = {}  # error type -> (window start, logs in window, suppressed)
+        self.__lock = threading.Lock()
+
+    @property
+    def path(self) -> Optional[str]:
+        if self.quarantine_dir is None:
+            return None
+        return os.path.join(self.quarantine_dir, f"quarantine-{self.run_id}.ndjson")
+
+    def reject(
+        self, record: Any, ex: Union[Exception, str], source_file: str, offset: int
+    ):
+        """Quarantine a record, ex being the validation error or its error type"""
+        reason = ex if isinstance(ex, str) else error_type(ex)
+        with self.__lock:
+            self.counters[reason] += 1
+            if self.quarantine_dir is not None:
+                self.__buffer.append(
+                    {
+                        "reason": reason,
+                        "source_file": source_file,
+                        "offset": offset,
+                        "record": record,
+                    }
+                )
+                if len(self.__buffer) >= self.batch_size:
+                    self.__flush()
+            self.__log_sample(reason, source_file, offset)
+
+    def __log_sample(self, reason: str, source_file: str, offset: int):
+        now = time.monotonic()
+        window_start, logged, suppressed = self.__log_windows.get(reason, (now, 0, 0))
+        if now - window_start >= self.log_interval:
+            window_start, logged = now, 0
+
+        if logged < self.max_logs_per_interval:
+            message = "Fail to process record %d from file %s due to %s" % (
+                offset,
+                source_file,
+                reason,
+            )
+            if suppressed:
+                message += " (%d similar rejections not logged)" % suppressed
+            logging.warning(message)
+            self.__log_windows[reason] = (window_start, logged + 1, 0)
+        else:
+            self.__log_windows[reason] = (window_start, logged, suppressed + 1)
+
+    def __flush(self):
+        if not self.__buffer:
+            return
+        os.makedirs(self.quarantine_dir, exist_ok=True)
+        with open(self.path, "a") as f:
+            f.write(
+                "".join(json.dumps(entry, default=str) + "\n" for entry in self.__buffer)
+            )
+        self.__buffer = []
+
+    def flush(self):
+        with self.__lock:
+            if self.quarantine_dir is not None:
+                self.__flush()
+
+    def close(self):
+        """Flush pending records and log the rejection counters"""
+        self.flush()
+        if self.counters:
+            logging.warning(
+                "Rejected %d records (%s)%s"
+                % (
+                    sum(self.counters.values()),
+                    ", ".join(f"{key}: {value}" for key, value in self.counters.items()),
+                    f", quarantined in {self.path}" if self.path else "",
+                )
+            )
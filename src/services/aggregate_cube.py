@@ -0,0 +1,157 @@
+import json
+import logging
+import os
+from src.models.pharmacy import Pharmacy
+from typing import Dict, List, Tuple
+
+
+class AggregateCube:
+    """
+    Materialized aggregates built once from the base (npi, ndc) sums.
+
+    Roll-ups kept by the cube:
+    - cells: (npi, ndc) -> fills, reverted, total_price, total_quantity
+    - chain_cells: (chain, ndc) -> total_price, total_quantity
+    - ndc_cells: ndc -> fills, reverted, total_price, total_quantity
+    - npi_cells: npi -> fills, reverted, total_price, total_quantity
+
+    The chain roll-up follows the Goal 3 rules: only (npi, ndc) cells with a
+    positive quantity and an npi mapped to a chain are considered.
+
+    Totals may be stored as scaled integers (e.g. cents), in which case
+    price_scale and quantity_scale are used to convert them back.
+
+    generation counts the incremental runs saved in a persisted cube, so the
+    claim index of these runs can be kept in sync with it (see ClaimIndex).
+    """
+
+    def __init__(
+        self,
+        cells: Dict[Tuple[str, str], Dict],
+        pharmacies: List[Pharmacy] = [],
+        price_scale: int = 1,
+        quantity_scale: int = 1,
+    ) -> None:
+        self.cells = cells
+        self.price_scale = price_scale
+        self.quantity_scale = quantity_scale
+        self.generation = 0
+        self.ndc_cells = {}
+        self.npi_cells = {}
+        self.__rollup_base()
+        self.remap_chains(pharmacies)
+
+    def __rollup_base(self):
+        for (npi, ndc), metrics in self.cells.items():
+            for rollup, key in ((self.ndc_cells, ndc), (self.npi_cells, npi)):
+                if key not in rollup:
+                    rollup[key] = dict(metrics)
+                else:
+                    for field in ("fills", "reverted", "total_price", "total_quantity"):
+                        rollup[key][field] += metrics[field]
+
+    def remap_chains(self, pharmacies: List[Pharmacy]):
+        """Replace the npi -> chain mapping and recompute only the chain roll-up"""
+        self.npi_to_chain = {}
+        for pharmacy in pharmacies:
+            self.npi_to_chain[pharmacy.npi] = pharmacy.chain
+        self.__rollup_chains()
+
+    def __rollup_chains(self):
+        self.chain_cells = {}
+        for (npi, ndc), metrics in self.cells.items():
+            if metrics["total_quantity"] <= 0 or npi not in self.npi_to_chain:
+                continue
+            key = (self.npi_to_chain[npi], ndc)
+            if key not in self.chain_cells:
+                self.chain_cells[key] = {
+                    "total_price": metrics["total_price"],
+                    "total_quantity": metrics["total_quantity"],
+                }
+            else:
+                self.chain_cells[key]["total_price"] += metrics["total_price"]
+                self.chain_cells[key]["total_quantity"] += metrics["total_quantity"]
+
+    def merge(self, other: "AggregateCube"):
+        """
+        Add the (npi, ndc) cells of another cube, e.g. the delta of a new run,
+        and recompute the roll-ups with this cube's chain mapping
+        """
+        if (other.price_scale, other.quantity_scale) != (
+            self.price_scale,
+            self.quantity_scale,
+        ):
+            raise ValueError("Cannot merge cubes with different price/quantity scales")
+        for key, metrics in other.cells.items():
+            if key not in self.cells:
+                self.cells[key] = dict(metrics)
+            else:
+                for field in ("fills", "reverted", "total_price", "total_quantity"):
+                    self.cells[key][field] += metrics[field]
+        self.ndc_cells = {}
+        self.npi_cells = {}
+        self.__rollup_base()
+        self.__rollup_chains()
+
+    def total_price(self, metrics: Dict) -> float:
+        return metrics["total_price"] / self.price_scale
+
+    def avg_price(self, metrics: Dict) -> float:
+        """Unit price of a cell, computed with a single division of the totals"""
+        if metrics["total_quantity"] <= 0:
+            return 0.0
+        return (metrics["total_price"] * self.quantity_scale) / (
+            metrics["total_quantity"] * self.price_scale
+        )
+
+    def save(self, path: str):
+        logging.info(f"Saving aggregate cube to {path}")
+        content = {
+            "price_scale": self.price_scale,
+            "quantity_scale": self.quantity_scale,
+            "generation": self.generation,
+            "npi_to_chain": self.npi_to_chain,
+            "cells": [
+                {"npi": npi, "ndc": ndc, **metrics}
+                for (npi, ndc), metrics in self.cells.items()
+            ],
+            "chain_cells": [
+                {"chain": chain, "ndc": ndc, **metrics}
+                for (chain, ndc), metrics in self.chain_cells.items()
+            ],
+            "ndc_cells": [
+                {"ndc": ndc, **metrics} for ndc, metrics in self.ndc_cells.items()
+            ],
+            "npi_cells": [
+                {"npi": npi, **metrics} for npi, metrics in self.npi_cells.items()
+            ],
+        }
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump(content, f)
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path: str) -> "AggregateCube":
+        """Load a persisted cube without recomputing any of its roll-ups"""
+        with open(path, "r") as f:
+            content = json.load(f)
+
+        cube = cls.__new__(cls)
+        cube.price_scale = content["price_scale"]
+        cube.quantity_scale = content["quantity_scale"]
+        cube.generation = content.get("generation", 0)
+        cube.npi_to_chain = content["npi_to_chain"]
+        cube.cells = {}
+        for record in content["cells"]:
+            cube.cells[(record.pop("npi"), record.pop("ndc"))] = record
+        cube.chain_cells = {}
+        for record in content["chain_cells"]:
+            cube.chain_cells[(record.pop("chain"), record.pop("ndc"))] = record
+        cube.ndc_cells = {}
+        for record in content["ndc_cells"]:
+            cube.ndc_cells[record.pop("ndc")] = record
+        cube.npi_cells = {}
+        for record in content["npi_cells"]:
+            cube.npi_cells[record.pop("npi")] = record
+        return cube
@@ -2,14 +2,83 @@ import logging
 from src.models.claim import Claim
 from src.models.revert import Revert
 from src.models.pharmacy import Pharmacy
+from src.repository.claim_index import ClaimIndex
+from src.repository.quarantine import QuarantineSink
 from .analytics_interface import AnalyticsInterface
-from typing import List
+from .aggregate_cube import AggregateCube
+from .cent_accumulator import (
+    CentAccumulator,
+    PRICE_SCALE,
+    QUANTITY_SCALE,
+    log_rounded_claims,
+)
+from .quantile_sketch import QuantileSketch, merge_sketch_maps
+from .streaming import parse_cursor, partition_by_ndc
+from typing import Dict, Iterator, List, Optional, Tuple
 import json
 
 
 class Analytics(AnalyticsInterface):
-    def __init__(self) -> None:
-        pass
+    def __init__(
+        self,
+        exact_prices: bool = False,
+        claim_index: Optional[ClaimIndex] = None,
+        quarantine: Optional[QuarantineSink] = None,
+    ) -> None:
+        """
+        exact_prices: accumulate prices and quantities as integer millionths
+        instead of floats (see CentAccumulator). Finer values are rounded to
+        the nearest millionth, with a warning.
+        claim_index: persistent index of the claims processed in previous runs.
+        When set, claims already indexed are ignored, new claims are added to
+        it, and reverts are applied once to claims of this run or of previous
+        runs, so the aggregates of a run are a delta over the previous runs.
+        """
+        self.exact_prices = exact_prices
+        self.claim_index = claim_index
+        self.quarantine = quarantine if quarantine is not None else QuarantineSink()
+
+    @property
+    def accepts_claim_columns(self) -> bool:
+        """Whether build_cube and most_prescribed_quantity_by_drug take ClaimColumns"""
+        return False
+
+    def __is_new_claim(self, claim: Claim, claims_by_id: Dict, offset: int) -> bool:
+        if claim.id in claims_by_id:
+            logging.debug(f"Ignored claim {claim.npi} because it's duplicated")
+            return False
+        if self.claim_index is not None and not ClaimIndex.fits(claim.npi, claim.ndc):
+            # offset is the position of the claim in the claims list
+            self.quarantine.reject(
+                claim.model_dump(mode="json"), "not_indexable:npi_ndc", "claims", offset
+            )
+            return False
+        if self.claim_index is not None and not self.claim_index.add(
+            claim.id, claim.npi, claim.ndc, claim.price, claim.quantity
+        ):
+            logging.debug(
+                f"Ignored claim {claim.npi} because it was processed in a previous run"
+            )
+            return False
+        return True
+
+    def __reverted_claim(self, revert: Revert, claims_by_id: Dict):
+        """(key, price, quantity) of the claim a revert applies to, or None"""
+        if self.claim_index is not None:
+            indexed = self.claim_index.mark_reverted(revert.claim_id)
+            if indexed is None:
+                logging.debug(
+                    f"Ignored revert {revert.id} because there is no valid claim_id linked to it or it was already reverted"
+                )
+                return None
+            return (indexed.npi, indexed.ndc), indexed.price, indexed.quantity
+
+        if revert.claim_id not in claims_by_id:
+            logging.debug(
+                f"Ignored revert {revert.id} because there is no valid claim_id linked to it"
+            )
+            return None
+        return claims_by_id[revert.claim_id]
 
     def __process_claims_and_reverts(
         self, claims: List[Claim], reverts: List[Revert], allowed_npis=[]
@@ -21,7 +90,7 @@ class Analytics(AnalyticsInterface):
         claims_by_id = {}
         data = {}
 
-        for claim in claims:
+        for offset, claim in enumerate(claims):
             if allowed_npis:
                 if claim.npi not in allowed_npis:
                     logging.debug(
@@ -29,17 +98,11 @@ class Analytics(AnalyticsInterface):
                     )
                     continue
 
-            if claim.id in claims_by_id:
-                logging.debug(f"Ignored claim {claim.npi} because it's duplicated")
+            if not self.__is_new_claim(claim, claims_by_id, offset):
                 continue
 
             key = (claim.npi, claim.ndc)
-
-            claims_by_id[claim.id] = {
-                "key": key,
-                "price": claim.price,
-                "quantity": claim.quantity,
-            }
+            claims_by_id[claim.id] = (key, claim.price, claim.quantity)
 
             if key in data.keys():
                 data[key]["fills"] += 1
@@ -55,42 +118,112 @@ class Analytics(AnalyticsInterface):
 
         # Process reverts
         for revert in reverts:
-            if revert.claim_id not in claims_by_id:
-                logging.debug(
-                    f"Ignored revert {revert.id} because there is no valid claim_id linked to it"
-                )
+            claim_data = self.__reverted_claim(revert, claims_by_id)
+            if claim_data is None:
                 continue
-            claim_data = claims_by_id[revert.claim_id]
-            claim_key = claim_data["key"]
-            data[claim_key]["total_price"] -= claim_data["price"]
-            data[claim_key]["total_quantity"] -= claim_data["quantity"]
+            claim_key, price, quantity = claim_data
+            if claim_key not in data:  # claim from a previous run
+                data[claim_key] = {
+                    "fills": 0,
+                    "reverted": 0,
+                    "total_price": 0.0,
+                    "total_quantity": 0.0,
+                }
+            data[claim_key]["total_price"] -= price
+            data[claim_key]["total_quantity"] -= quantity
             data[claim_key]["fills"] -= 1
             data[claim_key]["reverted"] += 1
 
         return data
 
-    def compute_metrics(
+    def __process_claims_and_reverts_exact(
         self, claims: List[Claim], reverts: List[Revert], allowed_npis=[]
     ):
-        results = []
+        """
+        Same as __process_claims_and_reverts, but totals are exact integers:
+        total_price and total_quantity in millionths
+        """
+        claims_by_id = {}
+        cell_codes = {}  # (npi, ndc) -> cell code, in first appearance order
+        claim_cells, claim_prices, claim_quantities = [], [], []
+
+        for offset, claim in enumerate(claims):
+            if allowed_npis:
+                if claim.npi not in allowed_npis:
+                    logging.debug(
+                        f"Ignored claim {claim.npi} because it's not included in the allowed npis list"
+                    )
+                    continue
+
+            if not self.__is_new_claim(claim, claims_by_id, offset):
+                continue
+
+            key = (claim.npi, claim.ndc)
+            claims_by_id[claim.id] = (key, claim.price, claim.quantity)
+            claim_cells.append(cell_codes.setdefault(key, len(cell_codes)))
+            claim_prices.append(claim.price)
+            claim_quantities.append(claim.quantity)
+
+        revert_cells, revert_prices, revert_quantities = [], [], []
+        for revert in reverts:
+            claim_data = self.__reverted_claim(revert, claims_by_id)
+            if claim_data is None:
+                continue
+            key, price, quantity = claim_data
+            revert_cells.append(cell_codes.setdefault(key, len(cell_codes)))
+            revert_prices.append(price)
+            revert_quantities.append(quantity)
+
+        # The claims are aggregated as columns, with vectorized int64 reductions
+        log_rounded_claims(claim_prices, claim_quantities)
+        accumulator = CentAccumulator(keys=list(cell_codes))
+        accumulator.add_batch(claim_cells, claim_prices, claim_quantities)
+        accumulator.subtract_batch(revert_cells, revert_prices, revert_quantities)
+        return accumulator.to_cells()
+
+    def build_cube(
+        self,
+        claims: List[Claim],
+        reverts: List[Revert],
+        pharmacies: List[Pharmacy] = [],
+        allowed_npis=[],
+    ) -> AggregateCube:
+        """Build the aggregate cube that Goals 2 and 3 are answered from"""
+        if self.exact_prices:
+            data = self.__process_claims_and_reverts_exact(
+                claims=claims, reverts=reverts, allowed_npis=allowed_npis
+            )
+            return AggregateCube(
+                cells=data,
+                pharmacies=pharmacies,
+                price_scale=PRICE_SCALE,
+                quantity_scale=QUANTITY_SCALE,
+            )
+
         data = self.__process_claims_and_reverts(
             claims=claims, reverts=reverts, allowed_npis=allowed_npis
-        )
+        )  # data: (npi, npc) ->  fills, reverted, total_price, total_quantity
+        return AggregateCube(cells=data, pharmacies=pharmacies)
 
-        for key_data, value in data.items():
-            if value["total_quantity"] > 0:
-                avg_price = value["total_price"] / value["total_quantity"]
-            else:
-                avg_price = 0.0
+    def compute_metrics(
+        self, claims: List[Claim], reverts: List[Revert], allowed_npis=[]
+    ):
+        cube = self.build_cube(
+            claims=claims, reverts=reverts, allowed_npis=allowed_npis
+        )
+        return self.metrics_from_cube(cube)
 
+    def metrics_from_cube(self, cube: AggregateCube):
+        results = []
+        for key_data, value in cube.cells.items():
             results.append(
                 {
                     "npi": key_data[0],  # npi
                     "ndc": key_data[1],  # ndc
                     "fills": value["fills"],
                     "reverted": value["reverted"],
-                    "avg_price": round(avg_price, 2),
-                    "total_price": round(value["total_price"], 2),
+                    "avg_price": round(cube.avg_price(value), 2),
+                    "total_price": round(cube.total_price(value), 2),
                 }
             )
 
@@ -103,37 +236,18 @@ class Analytics(AnalyticsInterface):
         pharmacies: List[Pharmacy],
         allowed_npis=[],
     ):
+        cube = self.build_cube(
+            claims=claims,
+            reverts=reverts,
+            pharmacies=pharmacies,
+            allowed_npis=allowed_npis,
+        )
+        return self.drug_recommendation_from_cube(cube)
 
-        data = self.__process_claims_and_reverts(
-            claims=claims, reverts=reverts, allowed_npis=allowed_npis
-        )  # data: (npi, npc) ->  fills, reverted, total_price, total_quantity
-
-        npi_to_chain = {}
-        for pharmacy in pharmacies:
-            npi_to_chain[pharmacy.npi] = pharmacy.chain
-
-        chain_data = {}  # ndc, chain -> total_price and total_quantity
-        for (npi, ndc), metrics in data.items():
-            if metrics["total_quantity"] <= 0 or npi not in npi_to_chain.keys():
-                continue
-            chain = npi_to_chain[npi]
-            key = (ndc, chain)
-            if key not in chain_data.keys():
-                chain_data[key] = {
-                    "total_price": metrics["total_price"],
-                    "total_quantity": metrics["total_quantity"],
-                }
-            else:
-                chain_data[key]["total_price"] += metrics["total_price"]
-                chain_data[key]["total_quantity"] += metrics["total_quantity"]
-
+    def drug_recommendation_from_cube(self, cube: AggregateCube):
         ndc_to_chains = {}  # ndc -> [(chain, avg_price)]
-        for (ndc, chain), value in chain_data.items():
-            avg_price = (
-                value["total_price"] / value["total_quantity"]
-                if value["total_quantity"] > 0
-                else 0.0
-            )
+        for (chain, ndc), value in cube.chain_cells.items():
+            avg_price = cube.avg_price(value)
             # Here we have the result, we just need to map it to a dict structure using ndc
             if ndc not in ndc_to_chains.keys():
                 ndc_to_chains[ndc] = [(chain, avg_price)]
@@ -152,6 +266,91 @@ class Analytics(AnalyticsInterface):
 
         return results
 
+    def build_price_sketches(
+        self,
+        claims: List[Claim],
+        reverts: List[Revert],
+        allowed_npis=[],
+        relative_accuracy: float = 0.01,
+    ) -> Dict[Tuple[str, str], QuantileSketch]:
+        """
+        Unit price (price / quantity) sketches by (npi, ndc). Reverted claims
+        are removed from the sketches, each claim at most once.
+        """
+        claims_by_id = {}
+        sketches = {}
+
+        for claim in claims:
+            if allowed_npis:
+                if claim.npi not in allowed_npis:
+                    continue
+            if claim.id in claims_by_id or claim.quantity <= 0:
+                continue
+
+            key = (claim.npi, claim.ndc)
+            unit_price = claim.price / claim.quantity
+            claims_by_id[claim.id] = (key, unit_price)
+            if key not in sketches:
+                sketches[key] = QuantileSketch(relative_accuracy=relative_accuracy)
+            sketches[key].add(unit_price)
+
+        for revert in reverts:
+            claim_data = claims_by_id.pop(revert.claim_id, None)
+            if claim_data is None:
+                logging.debug(
+                    f"Ignored revert {revert.id} because there is no valid claim_id linked to it"
+                )
+                continue
+            key, unit_price = claim_data
+            sketches[key].remove(unit_price)
+
+        return sketches
+
+    def unit_price_percentiles(
+        self,
+        claims: List[Claim],
+        reverts: List[Revert],
+        pharmacies: List[Pharmacy],
+        allowed_npis=[],
+    ):
+        sketches = self.build_price_sketches(
+            claims=claims, reverts=reverts, allowed_npis=allowed_npis
+        )
+        return self.unit_price_percentiles_from_sketches(sketches, pharmacies)
+
+    def unit_price_percentiles_from_sketches(
+        self,
+        sketches: Dict[Tuple[str, str], QuantileSketch],
+        pharmacies: List[Pharmacy],
+    ):
+        """p50/p90/p99 unit prices by (npi, ndc) and by (chain, ndc)"""
+        npi_to_chain = {}
+        for pharmacy in pharmacies:
+            npi_to_chain[pharmacy.npi] = pharmacy.chain
+
+        chain_sketches = {}  # (chain, ndc) -> sketch merged from its npis
+        for (npi, ndc), sketch in sketches.items():
+            if npi in npi_to_chain:
+                merge_sketch_maps(chain_sketches, {(npi_to_chain[npi], ndc): sketch})
+
+        def percentiles(sketch: QuantileSketch):
+            result = {}
+            for name, q in (("p50", 0.5), ("p90", 0.9), ("p99", 0.99)):
+                value = sketch.quantile(q)
+                result[name] = round(value, 2) if value is not None else None
+            return result
+
+        return {
+            "pharmacies": [
+                {"npi": npi, "ndc": ndc, **percentiles(sketch)}
+                for (npi, ndc), sketch in sketches.items()
+            ],
+            "chains": [
+                {"chain": chain, "ndc": ndc, **percentiles(sketch)}
+                for (chain, ndc), sketch in chain_sketches.items()
+            ],
+        }
+
     def most_prescribed_quantity_by_drug(
         self, claims: List[Claim], reverts: List[Revert], allowed_npis=[]
     ):
@@ -191,3 +390,86 @@ class Analytics(AnalyticsInterface):
             results.append(ndc_result)
 
         return results
+
+    # Streaming variants: results are yielded by ascending ndc (then npi for
+    # metrics), each ndc being aggregated only when it is reached. ndcs/npis
+    # restrict the claims before aggregation, and results up to cursor (see
+    # streaming.take_page) are skipped without being computed.
+
+    def __partitions(
+        self, claims, reverts, allowed_npis, ndcs, npis, cursor, **kwargs
+    ):
+        if self.claim_index is not None:
+            raise ValueError("Streaming results are not supported with a claim index")
+        partitions = partition_by_ndc(
+            claims=claims,
+            reverts=reverts,
+            allowed_npis=allowed_npis,
+            ndcs=ndcs,
+            npis=npis,
+            **kwargs,
+        )
+        after = parse_cursor(cursor)
+        for ndc in sorted(partitions):
+            if after and ndc < after[0]:
+                continue
+            yield ndc, partitions[ndc]
+
+    def iter_metrics(
+        self,
+        claims: List[Claim],
+        reverts: List[Revert],
+        allowed_npis=[],
+        ndcs=None,
+        npis=None,
+        cursor: Optional[str] = None,
+    ) -> Iterator[Dict]:
+        after = parse_cursor(cursor)
+        for ndc, (ndc_claims, ndc_reverts) in self.__partitions(
+            claims, reverts, allowed_npis, ndcs, npis, cursor
+        ):
+            cube = self.build_cube(claims=ndc_claims, reverts=ndc_reverts)
+            for result in sorted(self.metrics_from_cube(cube), key=lambda x: x["npi"]):
+                if (ndc, result["npi"]) > after:
+                    yield result
+
+    def iter_drug_recommendation_by_chains(
+        self,
+        claims: List[Claim],
+        reverts: List[Revert],
+        pharmacies: List[Pharmacy],
+        allowed_npis=[],
+        ndcs=None,
+        npis=None,
+        cursor: Optional[str] = None,
+    ) -> Iterator[Dict]:
+        after = parse_cursor(cursor)
+        for ndc, (ndc_claims, ndc_reverts) in self.__partitions(
+            claims, reverts, allowed_npis, ndcs, npis, cursor
+        ):
+            if (ndc,) <= after:
+                continue
+            cube = self.build_cube(
+                claims=ndc_claims, reverts=ndc_reverts, pharmacies=pharmacies
+            )
+            yield from self.drug_recommendation_from_cube(cube)
+
+    def iter_most_prescribed_quantity_by_drug(
+        self,
+        claims: List[Claim],
+        reverts: List[Revert],
+        allowed_npis=[],
+        ndcs=None,
+        npis=None,
+        cursor: Optional[str] = None,
+    ) -> Iterator[Dict]:
+        after = parse_cursor(cursor)
+        # Goal 4 counts duplicated claims, so partitions are not deduplicated
+        for ndc, (ndc_claims, ndc_reverts) in self.__partitions(
+            claims, reverts, allowed_npis, ndcs, npis, cursor, deduplicate=False
+        ):
+            if (ndc,) <= after:
+                continue
+            yield from self.most_prescribed_quantity_by_drug(
+                claims=ndc_claims, reverts=ndc_reverts
+            )
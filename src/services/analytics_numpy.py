@@ -0,0 +1,298 @@
+import numpy as np
+from src.models.claim import Claim
+from src.models.claim_columns import ClaimColumns
+from src.models.revert import Revert
+from src.models.pharmacy import Pharmacy
+from .analytics import Analytics
+from .aggregate_cube import AggregateCube
+from .cent_accumulator import (
+    CentAccumulator,
+    PRICE_SCALE,
+    QUANTITY_SCALE,
+    log_rounded_claims,
+)
+from typing import List, Optional, Union
+
+# 64-bit FNV-1a parameters
+HASH_OFFSET = 0xCBF29CE484222325
+HASH_PRIME = np.uint64(0x100000001B3)
+
+
+def hash_strings(values: np.ndarray, width: Optional[int] = None) -> np.ndarray:
+    """
+    64-bit FNV-1a hash of each string of a unicode array, two characters (one
+    uint64 word) at a time. Strings are hashed with their NUL padding to
+    width characters (by default the width of the array), so only hashes of
+    the same width can be compared.
+    """
+    if width is None:
+        width = values.dtype.itemsize // 4
+    width = max(width + width % 2, 2)
+    words = (
+        values.astype(f"<U{width}")
+        .view(np.uint64)
+        .reshape(len(values), width // 2)
+    )
+    hashes = np.full(len(values), HASH_OFFSET, dtype=np.uint64)
+    for column in words.T:
+        hashes ^= column
+        hashes *= HASH_PRIME
+    return hashes
+
+
+def encode_first_seen(values: np.ndarray):
+    """
+    Encode values as integer codes numbered by first appearance, returning
+    (uniques in first appearance order, codes, first index of each unique).
+
+    Strings are grouped by their 64-bit hash, which sorts integers instead of
+    strings, and checked against the first string of their group (on a hash
+    collision, the strings themselves are sorted). Small non-negative integers
+    are grouped with a lookup table instead of a sort.
+    """
+    if values.dtype.kind == "U":
+        _, codes, first_index = encode_first_seen(hash_strings(values))
+        uniques = values[first_index]
+        if np.array_equal(uniques[codes], values):
+            return uniques, codes, first_index
+    elif (
+        values.dtype.kind in "iu"
+        and len(values)
+        and values.min() >= 0
+        and values.max() < 4 * len(values)
+    ):
+        first_index = np.full(int(values.max()) + 1, len(values), dtype=np.int64)
+        np.minimum.at(first_index, values, np.arange(len(values)))
+        present = np.flatnonzero(first_index < len(values))
+        order = np.argsort(first_index[present], kind="stable")
+        rank = np.empty(len(first_index), dtype=np.int64)
+        rank[present[order]] = np.arange(len(order))
+        first_index = first_index[present[order]]
+        return values[first_index], rank[values], first_index
+
+    order, _, is_first, first_rows = sorted_groups(values)
+    first_index = first_rows[is_first]
+    first_order = np.argsort(first_index)
+    rank = np.empty(len(first_index), dtype=np.int64)
+    rank[first_order] = np.arange(len(first_order))
+    codes = np.empty(len(values), dtype=np.int64)
+    codes[order] = rank[np.cumsum(is_first) - 1]
+    first_index = first_index[first_order]
+    return values[first_index], codes, first_index
+
+
+def sorted_groups(keys: np.ndarray):
+    """
+    Group equal keys with an unstable sort, returning (order sorting the
+    keys, sorted keys, mask of the first position of each group, smallest
+    original index of the group at each sorted position).
+    """
+    order = np.argsort(keys)
+    sorted_keys = keys[order]
+    is_first = np.ones(len(keys), dtype=bool)
+    is_first[1:] = sorted_keys[1:] != sorted_keys[:-1]
+    starts = np.flatnonzero(is_first)
+    if not len(starts):
+        return order, sorted_keys, is_first, order
+    group_first = np.minimum.reduceat(order, starts)
+    first_rows = np.repeat(group_first, np.diff(starts, append=len(keys)))
+    return order, sorted_keys, is_first, first_rows
+
+
+class NumpyAnalytics(Analytics):
+    """
+    Vectorized implementation of the analytics goals over columnar batches.
+
+    npis and ndcs are encoded once, and the allowed npis are checked on the
+    distinct npis only. Claims are deduplicated and reverts matched on sorted
+    64-bit hashes of the claim ids, (npi, ndc) cells are reduced with bincount
+    and Goal 4 is a histogram over encoded (ndc, quantity) pairs. Float totals are
+    accumulated claim by claim and then revert by revert, exactly as in
+    Analytics, so both engines produce identical outputs.
+    """
+
+    @property
+    def accepts_claim_columns(self) -> bool:
+        # With a claim index, claims are processed one by one by Analytics
+        return self.claim_index is None
+
+    def __allowed_mask(self, npis: np.ndarray, allowed_npis) -> np.ndarray:
+        if not allowed_npis:
+            return np.ones(len(npis), dtype=bool)
+        npi_values, npi_codes, _ = encode_first_seen(npis)
+        return np.isin(npi_values, np.array(list(allowed_npis), dtype=str))[npi_codes]
+
+    def __reverted_mask(self, ids: np.ndarray, reverts: List[Revert]) -> np.ndarray:
+        """Claims whose id is reverted, matched on id hashes then on the ids"""
+        revert_ids = np.array([revert.claim_id for revert in reverts], dtype=str)
+        width = ids.dtype.itemsize // 4
+        reverted = np.isin(hash_strings(ids), hash_strings(revert_ids, width))
+        candidates = np.flatnonzero(reverted)
+        reverted[candidates] = np.isin(ids[candidates], revert_ids)
+        return reverted
+
+    def build_cube(
+        self,
+        claims: Union[List[Claim], ClaimColumns],
+        reverts: List[Revert],
+        pharmacies: List[Pharmacy] = [],
+        allowed_npis=[],
+    ) -> AggregateCube:
+        if self.claim_index is not None:
+            # The claim index is probed and updated claim by claim
+            return super().build_cube(
+                claims=claims,
+                reverts=reverts,
+                pharmacies=pharmacies,
+                allowed_npis=allowed_npis,
+            )
+
+        columns = (
+            claims
+            if isinstance(claims, ClaimColumns)
+            else ClaimColumns.from_claims(claims)
+        )
+
+        # npis and ndcs are encoded once, for the allowed npis and the cells
+        npi_values, npi_codes, _ = encode_first_seen(columns.npi)
+        ndc_values, ndc_codes, _ = encode_first_seen(columns.ndc)
+        if allowed_npis:
+            allowed = np.isin(npi_values, np.array(list(allowed_npis), dtype=str))
+            rows = np.flatnonzero(allowed[npi_codes])
+        else:
+            rows = np.arange(len(columns))
+
+        # First occurrence of each claim id, grouped by id hash
+        ids = columns.id[rows]
+        keys = hash_strings(ids)
+        order, sorted_keys, is_first, first_rows = sorted_groups(keys)
+        if not np.array_equal(ids[order], ids[first_rows]):
+            # 64-bit hash collision: group the ids themselves
+            keys = ids
+            order, sorted_keys, is_first, first_rows = sorted_groups(keys)
+        unique_keys = sorted_keys[is_first]
+        unique_rows = first_rows[is_first]  # positions in rows, in unique_keys order
+        kept = np.sort(unique_rows)
+
+        # Reverts linked to a valid claim, kept in revert order
+        revert_ids = np.array([revert.claim_id for revert in reverts], dtype=str)
+        revert_keys = (
+            hash_strings(revert_ids, ids.dtype.itemsize // 4)
+            if keys is not ids
+            else revert_ids
+        )
+        if len(unique_keys):
+            position = np.searchsorted(unique_keys, revert_keys)
+            position[position >= len(unique_keys)] = 0
+            matched = (unique_keys[position] == revert_keys) & (
+                ids[unique_rows[position]] == revert_ids
+            )
+            reverted_rows = np.searchsorted(kept, unique_rows[position[matched]])
+        else:
+            reverted_rows = np.zeros(0, dtype=np.int64)
+
+        rows = rows[kept]
+        npi_codes = npi_codes[rows]
+        ndc_codes = ndc_codes[rows]
+        _, cell_codes, cell_first_index = encode_first_seen(
+            npi_codes * len(ndc_values) + ndc_codes
+        )
+        cell_count = len(cell_first_index)
+        reverted_cells = cell_codes[reverted_rows]
+
+        prices = columns.price[rows]
+        quantities = columns.quantity[rows]
+        cell_keys = list(
+            zip(
+                npi_values[npi_codes[cell_first_index]].tolist(),
+                ndc_values[ndc_codes[cell_first_index]].tolist(),
+            )
+        )
+        if self.exact_prices:
+            log_rounded_claims(prices, quantities)
+            accumulator = CentAccumulator(keys=cell_keys)
+            accumulator.add_batch(cell_codes, prices, quantities)
+            accumulator.subtract_batch(
+                reverted_cells, prices[reverted_rows], quantities[reverted_rows]
+            )
+            return AggregateCube(
+                cells=accumulator.to_cells(),
+                pharmacies=pharmacies,
+                price_scale=PRICE_SCALE,
+                quantity_scale=QUANTITY_SCALE,
+            )
+
+        claim_fills = np.bincount(cell_codes, minlength=cell_count)
+        reverted = np.bincount(reverted_cells, minlength=cell_count)
+        fills = claim_fills - reverted
+        # bincount adds the weights in input order: claims first, then reverts
+        all_cells = np.concatenate([cell_codes, reverted_cells])
+        total_price = np.bincount(
+            all_cells,
+            weights=np.concatenate([prices, -prices[reverted_rows]]),
+            minlength=cell_count,
+        )
+        total_quantity = np.bincount(
+            all_cells,
+            weights=np.concatenate([quantities, -quantities[reverted_rows]]),
+            minlength=cell_count,
+        )
+
+        fills = fills.tolist()
+        reverted = reverted.tolist()
+        total_price = total_price.tolist()
+        total_quantity = total_quantity.tolist()
+        data = {
+            key: {
+                "fills": fills[i],
+                "reverted": reverted[i],
+                "total_price": total_price[i],
+                "total_quantity": total_quantity[i],
+            }
+            for i, key in enumerate(cell_keys)
+        }
+        return AggregateCube(cells=data, pharmacies=pharmacies)
+
+    def most_prescribed_quantity_by_drug(
+        self,
+        claims: Union[List[Claim], ClaimColumns],
+        reverts: List[Revert],
+        allowed_npis=[],
+    ):
+        columns = (
+            claims
+            if isinstance(claims, ClaimColumns)
+            else ClaimColumns.from_claims(claims)
+        )
+        mask = ~self.__reverted_mask(columns.id, reverts) & self.__allowed_mask(
+            columns.npi, allowed_npis
+        )
+        ndc = columns.ndc[mask]
+        quantity = columns.quantity[mask]
+        if len(ndc) == 0:
+            return []
+
+        # Histogram of (ndc, quantity) pairs
+        ndc_values, ndc_codes, _ = encode_first_seen(ndc)
+        _, quantity_codes, _ = encode_first_seen(quantity)
+        _, pair_codes, pair_first_index = encode_first_seen(
+            ndc_codes.astype(np.int64) * (int(quantity_codes.max()) + 1)
+            + quantity_codes
+        )
+        pair_counts = np.bincount(pair_codes)
+        pair_ndc = ndc_codes[pair_first_index]
+
+        # ndc by first appearance, then count desc, then quantity first appearance
+        order = np.lexsort((pair_first_index, -pair_counts, pair_ndc))
+        sorted_quantities = quantity[pair_first_index[order]].tolist()
+        boundaries = np.flatnonzero(np.diff(pair_ndc[order])) + 1
+        starts = [0] + boundaries.tolist()
+        ends = boundaries.tolist() + [len(order)]
+
+        return [
+            {
+                "ndc": ndc_value,
+                "most_prescribed_quantity": sorted_quantities[start:end],
+            }
+            for ndc_value, start, end in zip(ndc_values.tolist(), starts, ends)
+        ]
@@ -0,0 +1,110 @@
+import logging
+import numpy as np
+from typing import Dict, List, Tuple
+
+# Exact totals are integer millionths of a price unit and of a quantity unit.
+# Claims with more decimals are rounded to the nearest millionth.
+PRICE_SCALE = 10**6
+QUANTITY_SCALE = 10**6
+
+# A value is representable at a scale when value * scale is an integer, up to
+# the float error of the decimal value (e.g. 0.1 * 100 = 10.000000000000002)
+RELATIVE_TOLERANCE = 1e-9
+ABSOLUTE_TOLERANCE = 1e-6
+
+
+def representable_mask(values, scale: int) -> np.ndarray:
+    scaled = np.asarray(values, dtype=np.float64) * scale
+    return np.isclose(
+        scaled, np.rint(scaled), rtol=RELATIVE_TOLERANCE, atol=ABSOLUTE_TOLERANCE
+    )
+
+
+def log_rounded_claims(prices, quantities):
+    """Warn about the claims whose price or quantity is rounded to the exact units"""
+    rounded = np.count_nonzero(
+        ~representable_mask(prices, PRICE_SCALE)
+        | ~representable_mask(quantities, QUANTITY_SCALE)
+    )
+    if rounded:
+        logging.warning(
+            f"{rounded} claims have a price or quantity finer than a millionth, rounded to the nearest millionth"
+        )
+
+
+def to_price_units(prices) -> np.ndarray:
+    return np.rint(np.asarray(prices, dtype=np.float64) * PRICE_SCALE).astype(
+        np.int64
+    )
+
+
+def to_quantity_units(quantities) -> np.ndarray:
+    return np.rint(
+        np.asarray(quantities, dtype=np.float64) * QUANTITY_SCALE
+    ).astype(np.int64)
+
+
+def sum_by_cell(cells: np.ndarray, units: np.ndarray, cell_count: int) -> np.ndarray:
+    """Exact int64 sums of units by cell code (np.bincount would sum float64)"""
+    sums = np.zeros(cell_count, dtype=np.int64)
+    if len(cells) == 0:
+        return sums
+    order = np.argsort(cells, kind="stable")
+    sorted_cells = cells[order]
+    starts = np.flatnonzero(np.diff(sorted_cells, prepend=-1))
+    sums[sorted_cells[starts]] = np.add.reduceat(units[order], starts)
+    return sums
+
+
+class CentAccumulator:
+    """
+    Exact (npi, ndc) accumulator backed by contiguous int64 arrays.
+
+    keys[i] is the (npi, ndc) key of cell code i. Claim/revert batches are
+    columns (cell codes, prices, quantities): the values are converted to
+    int64 units and summed by cell with a sort and np.add.reduceat, so totals
+    do not depend on the order or the partitioning of the input files.
+    """
+
+    def __init__(self, keys: List[Tuple[str, str]]) -> None:
+        self.keys = keys
+        self.fills = np.zeros(len(keys), dtype=np.int64)
+        self.reverted = np.zeros(len(keys), dtype=np.int64)
+        self.total_price = np.zeros(len(keys), dtype=np.int64)
+        self.total_quantity = np.zeros(len(keys), dtype=np.int64)
+
+    def add_batch(self, cells, prices, quantities):
+        """Add a batch of claims"""
+        cells = np.asarray(cells, dtype=np.int64)
+        self.fills += np.bincount(cells, minlength=len(self.keys))
+        self.total_price += sum_by_cell(cells, to_price_units(prices), len(self.keys))
+        self.total_quantity += sum_by_cell(
+            cells, to_quantity_units(quantities), len(self.keys)
+        )
+
+    def subtract_batch(self, cells, prices, quantities):
+        """Remove a batch of reverted claims"""
+        cells = np.asarray(cells, dtype=np.int64)
+        reverted = np.bincount(cells, minlength=len(self.keys))
+        self.fills -= reverted
+        self.reverted += reverted
+        self.total_price -= sum_by_cell(cells, to_price_units(prices), len(self.keys))
+        self.total_quantity -= sum_by_cell(
+            cells, to_quantity_units(quantities), len(self.keys)
+        )
+
+    def to_cells(self) -> Dict[Tuple[str, str], Dict]:
+        """(npi, ndc) -> fills, reverted, total_price, total_quantity (in millionths)"""
+        fills = self.fills.tolist()
+        reverted = self.reverted.tolist()
+        total_price = self.total_price.tolist()
+        total_quantity = self.total_quantity.tolist()
+        return {
+            key: {
+                "fills": fills[row],
+                "reverted": reverted[row],
+                "total_price": total_price[row],
+                "total_quantity": total_quantity[row],
+            }
+            for row, key in enumerate(self.keys)
+        }
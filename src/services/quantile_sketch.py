@@ -0,0 +1,139 @@
+import math
+from typing import Dict, Hashable, Optional
+
+
+class QuantileSketch:
+    """
+    Mergeable quantile sketch with relative error guarantees (DDSketch style).
+
+    Values are counted in logarithmic buckets, bucket k covering
+    (gamma^(k-1), gamma^k] with gamma = (1 + relative_accuracy) / (1 - relative_accuracy),
+    so any quantile is returned within relative_accuracy of the exact one.
+    Since a bucket only holds a count, values can be removed (e.g. reverted
+    claims) as well as added, and two sketches merge by adding their counts.
+
+    Memory is bounded by max_buckets: when exceeded, the lowest buckets are
+    collapsed together, which only affects the accuracy of the lowest quantiles.
+    Values lower or equal to zero are counted as 0.
+    """
+
+    def __init__(self, relative_accuracy: float = 0.01, max_buckets: int = 2048):
+        if not 0 < relative_accuracy < 1:
+            raise ValueError("relative_accuracy must be between 0 and 1")
+        self.relative_accuracy = relative_accuracy
+        self.max_buckets = max_buckets
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self.__log_gamma = math.log(self.gamma)
+        self.buckets: Dict[int, int] = {}
+        self.zero_count = 0
+        self.count = 0
+        self.floor_key: Optional[int] = None  # lower keys are collapsed into it
+
+    def __key(self, value: float) -> Optional[int]:
+        if value <= 0:
+            return None
+        key = math.ceil(math.log(value) / self.__log_gamma)
+        if self.floor_key is not None and key < self.floor_key:
+            return self.floor_key
+        return key
+
+    def __collapse(self):
+        keys = sorted(self.buckets)
+        excess = keys[: len(keys) - self.max_buckets]
+        self.floor_key = keys[len(excess)]
+        for key in excess:
+            self.buckets[self.floor_key] += self.buckets.pop(key)
+
+    def add(self, value: float, count: int = 1):
+        key = self.__key(value)
+        if key is None:
+            self.zero_count += count
+        else:
+            self.buckets[key] = self.buckets.get(key, 0) + count
+            if len(self.buckets) > self.max_buckets:
+                self.__collapse()
+        self.count += count
+
+    def remove(self, value: float, count: int = 1):
+        """Remove a value previously added to the sketch"""
+        key = self.__key(value)
+        if key is None:
+            if self.zero_count < count:
+                raise ValueError(f"Value {value} was not added to the sketch")
+            self.zero_count -= count
+        else:
+            if self.buckets.get(key, 0) < count:
+                raise ValueError(f"Value {value} was not added to the sketch")
+            self.buckets[key] -= count
+            if self.buckets[key] == 0:
+                del self.buckets[key]
+        self.count -= count
+
+    def merge(self, other: "QuantileSketch"):
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Cannot merge sketches with different accuracies")
+        self.zero_count += other.zero_count
+        self.count += other.count
+        if other.floor_key is not None and (
+            self.floor_key is None or other.floor_key > self.floor_key
+        ):
+            self.floor_key = other.floor_key
+            for key in [key for key in self.buckets if key < self.floor_key]:
+                self.buckets[self.floor_key] = self.buckets.get(
+                    self.floor_key, 0
+                ) + self.buckets.pop(key)
+        for key, count in other.buckets.items():
+            if self.floor_key is not None and key < self.floor_key:
+                key = self.floor_key
+            self.buckets[key] = self.buckets.get(key, 0) + count
+        if len(self.buckets) > self.max_buckets:
+            self.__collapse()
+
+    def quantile(self, q: float) -> Optional[float]:
+        """Approximate q-quantile (0 <= q <= 1), None if the sketch is empty"""
+        if self.count <= 0:
+            return None
+        rank = q * (self.count - 1)
+        seen = self.zero_count
+        if rank < seen:
+            return 0.0
+        for key in sorted(self.buckets):
+            seen += self.buckets[key]
+            if rank < seen:
+                return 2 * self.gamma**key / (self.gamma + 1)
+        return 2 * self.gamma ** max(self.buckets) / (self.gamma + 1)
+
+    def to_dict(self) -> Dict:
+        return {
+            "relative_accuracy": self.relative_accuracy,
+            "max_buckets": self.max_buckets,
+            "zero_count": self.zero_count,
+            "floor_key": self.floor_key,
+            "buckets": {str(key): count for key, count in self.buckets.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, content: Dict) -> "QuantileSketch":
+        sketch = cls(
+            relative_accuracy=content["relative_accuracy"],
+            max_buckets=content["max_buckets"],
+        )
+        sketch.zero_count = content["zero_count"]
+        sketch.floor_key = content["floor_key"]
+        sketch.buckets = {int(key): count for key, count in content["buckets"].items()}
+        sketch.count = sketch.zero_count + sum(sketch.buckets.values())
+        return sketch
+
+
+def merge_sketch_maps(
+    target: Dict[Hashable, QuantileSketch], other: Dict[Hashable, QuantileSketch]
+) -> Dict[Hashable, QuantileSketch]:
+    """Merge sketches keyed by group (e.g. built from different files or workers) into target"""
+    for key, sketch in other.items():
+        if key not in target:
+            target[key] = QuantileSketch(
+                relative_accuracy=sketch.relative_accuracy,
+                max_buckets=sketch.max_buckets,
+            )
+        target[key].merge(sketch)
+    return target
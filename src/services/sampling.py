@@ -0,0 +1,306 @@
+import hashlib
+import math
+from statistics import NormalDist
+from src.models.claim import Claim
+from src.models.revert import Revert
+from src.models.pharmacy import Pharmacy
+from src.repository.json_database import JSONDatabase
+from .analytics import Analytics
+from typing import Dict, List, NamedTuple, Optional, Set, Tuple
+
+
+def hash_fraction(claim_id: str) -> float:
+    """Deterministic pseudo-random number in [0, 1) derived from a claim id"""
+    digest = hashlib.blake2b(claim_id.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "little") / 2**64
+
+
+class ClaimSample(NamedTuple):
+    claims: List[Claim]
+    reverts: List[Revert]
+    rates: Dict[str, float]  # ndc -> sampling rate
+
+
+class ClaimFilter:
+    """
+    Record filter keeping the raw claim records that are sampled at the rate
+    of their ndc. Malformed records are kept, so that they are validated and
+    quarantined as in a full read.
+    """
+
+    def __init__(self, rates: Dict[str, float]) -> None:
+        self.rates = rates
+
+    def __call__(self, record) -> bool:
+        if not isinstance(record, dict):
+            return True
+        claim_id, ndc = record.get("id"), record.get("ndc")
+        if not isinstance(claim_id, str) or not isinstance(ndc, str):
+            return True
+        return hash_fraction(claim_id) < self.rates.get(ndc, 1.0)
+
+
+class RevertFilter:
+    """Record filter keeping the raw revert records of the sampled claims"""
+
+    def __init__(self, claim_ids: Set[str]) -> None:
+        self.claim_ids = claim_ids
+
+    def __call__(self, record) -> bool:
+        if not isinstance(record, dict):
+            return True
+        claim_id = record.get("claim_id")
+        return not isinstance(claim_id, str) or claim_id in self.claim_ids
+
+
+class StratifiedSampler:
+    """
+    Deterministic sample of the claims, stratified by ndc.
+
+    A claim is kept when hash_fraction(claim.id) is below the rate of its ndc,
+    so a claim is sampled the same way in every run and a revert is kept
+    exactly when its claim is. Each ndc is sampled at `rate`, raised so that
+    at least min_per_stratum claims are expected in every ndc.
+    """
+
+    def __init__(self, rate: float, min_per_stratum: int = 30) -> None:
+        if not 0 < rate <= 1:
+            raise ValueError("rate must be in (0, 1]")
+        self.rate = rate
+        self.min_per_stratum = min_per_stratum
+
+    def rates(self, stratum_sizes: Dict[str, int]) -> Dict[str, float]:
+        """ndc -> sampling rate, from the number of claims of each ndc"""
+        return {
+            ndc: min(1.0, max(self.rate, self.min_per_stratum / size))
+            for ndc, size in stratum_sizes.items()
+        }
+
+    def sample(self, claims: List[Claim], reverts: List[Revert]) -> ClaimSample:
+        stratum_sizes = {}
+        for claim in claims:
+            stratum_sizes[claim.ndc] = stratum_sizes.get(claim.ndc, 0) + 1
+        rates = self.rates(stratum_sizes)
+
+        sampled_claims = [
+            claim for claim in claims if hash_fraction(claim.id) < rates[claim.ndc]
+        ]
+        sampled_ids = {claim.id for claim in sampled_claims}
+        sampled_reverts = [
+            revert for revert in reverts if revert.claim_id in sampled_ids
+        ]
+        return ClaimSample(claims=sampled_claims, reverts=sampled_reverts, rates=rates)
+
+    def sample_database(self, database: JSONDatabase) -> ClaimSample:
+        """
+        Draw the sample while reading the data files: the strata are counted on
+        the raw claim records, and only the sampled records are validated.
+        """
+        rates = self.rates(database.count_claims_by("ndc"))
+        claims = database.retrieve_claims(record_filter=ClaimFilter(rates))
+        reverts = database.retrieve_reverts(
+            record_filter=RevertFilter({claim.id for claim in claims})
+        )
+        return ClaimSample(claims=claims, reverts=reverts, rates=rates)
+
+
+class ApproximateAnalytics:
+    """
+    Goals 2, 3 and 4 estimated from a ClaimSample, annotated with error bounds.
+
+    - Counts and totals are scaled by the inverse of the ndc sampling rate.
+    - avg_price is a ratio estimator (sum of prices / sum of quantities), with a
+      normal confidence interval from its linearized variance.
+    - rank_confidence is the probability that an item of a ranking would still
+      be ranked before the next one over the full data (normal approximation).
+    """
+
+    def __init__(
+        self, analytics: Optional[Analytics] = None, confidence: float = 0.95
+    ) -> None:
+        self.analytics = analytics if analytics is not None else Analytics()
+        self.confidence = confidence
+        self.z = NormalDist().inv_cdf((1 + confidence) / 2)
+
+    def __moments(
+        self, sample: ClaimSample, allowed_npis=[]
+    ) -> Dict[Tuple[str, str], List[float]]:
+        """(npi, ndc) -> [n, sum p, sum q, sum p^2, sum q^2, sum pq] of the non reverted claims"""
+        reverted_ids = {revert.claim_id for revert in sample.reverts}
+        seen_ids = set()
+        moments = {}
+        for claim in sample.claims:
+            if allowed_npis and claim.npi not in allowed_npis:
+                continue
+            if claim.id in seen_ids or claim.id in reverted_ids:
+                continue
+            seen_ids.add(claim.id)
+            key = (claim.npi, claim.ndc)
+            if key not in moments:
+                moments[key] = [0, 0.0, 0.0, 0.0, 0.0, 0.0]
+            values = moments[key]
+            values[0] += 1
+            values[1] += claim.price
+            values[2] += claim.quantity
+            values[3] += claim.price**2
+            values[4] += claim.quantity**2
+            values[5] += claim.price * claim.quantity
+        return moments
+
+    @staticmethod
+    def __ratio_standard_error(moments: List[float], rate: float) -> Optional[float]:
+        n, sum_p, sum_q, sum_pp, sum_qq, sum_pq = moments
+        if n < 2 or sum_q <= 0:
+            return None
+        ratio = sum_p / sum_q
+        residual_variance = max(
+            (sum_pp - 2 * ratio * sum_pq + ratio**2 * sum_qq) / (n - 1), 0.0
+        )
+        mean_q = sum_q / n
+        return math.sqrt((1 - rate) * residual_variance / n) / mean_q
+
+    def __interval(self, value: float, standard_error: Optional[float]):
+        if standard_error is None:
+            return None
+        return [
+            round(value - self.z * standard_error, 2),
+            round(value + self.z * standard_error, 2),
+        ]
+
+    def compute_metrics(self, sample: ClaimSample, allowed_npis=[]):
+        cube = self.analytics.build_cube(
+            claims=sample.claims, reverts=sample.reverts, allowed_npis=allowed_npis
+        )
+        moments = self.__moments(sample, allowed_npis)
+
+        results = []
+        for result in self.analytics.metrics_from_cube(cube):
+            key = (result["npi"], result["ndc"])
+            rate = sample.rates.get(result["ndc"], 1.0)
+            avg_price = cube.avg_price(cube.cells[key])
+            standard_error = (
+                self.__ratio_standard_error(moments[key], rate)
+                if key in moments
+                else None
+            )
+            result.update(
+                {
+                    "fills": round(result["fills"] / rate),
+                    "reverted": round(result["reverted"] / rate),
+                    "total_price": round(cube.total_price(cube.cells[key]) / rate, 2),
+                    "avg_price_ci": self.__interval(avg_price, standard_error),
+                    "sample_rate": rate,
+                }
+            )
+            results.append(result)
+        return results
+
+    def drug_recommendation_by_chains(
+        self, sample: ClaimSample, pharmacies: List[Pharmacy], allowed_npis=[]
+    ):
+        cube = self.analytics.build_cube(
+            claims=sample.claims,
+            reverts=sample.reverts,
+            pharmacies=pharmacies,
+            allowed_npis=allowed_npis,
+        )
+
+        # Chain moments are the sum of the moments of their (npi, ndc) cells
+        chain_moments = {}
+        for (npi, ndc), values in self.__moments(sample, allowed_npis).items():
+            if (npi, ndc) not in cube.cells or npi not in cube.npi_to_chain:
+                continue
+            if cube.cells[(npi, ndc)]["total_quantity"] <= 0:
+                continue
+            key = (cube.npi_to_chain[npi], ndc)
+            if key not in chain_moments:
+                chain_moments[key] = [0, 0.0, 0.0, 0.0, 0.0, 0.0]
+            chain_moments[key] = [a + b for a, b in zip(chain_moments[key], values)]
+
+        ndc_to_chains = {}  # ndc -> [(chain, avg_price, standard error)]
+        for (chain, ndc), value in cube.chain_cells.items():
+            standard_error = (
+                self.__ratio_standard_error(
+                    chain_moments[(chain, ndc)], sample.rates.get(ndc, 1.0)
+                )
+                if (chain, ndc) in chain_moments
+                else None
+            )
+            ndc_to_chains.setdefault(ndc, []).append(
+                (chain, cube.avg_price(value), standard_error)
+            )
+
+        results = []
+        for ndc, chain_info in ndc_to_chains.items():
+            chain_info.sort(key=lambda x: x[1])  # Here we order by avg_price
+            formatted_chains = []
+            for i, (chain, avg_price, standard_error) in enumerate(chain_info[:2]):
+                rank_confidence = 1.0
+                if i + 1 < len(chain_info):
+                    next_avg_price, next_standard_error = chain_info[i + 1][1:]
+                    rank_confidence = self.__rank_confidence(
+                        next_avg_price - avg_price,
+                        standard_error,
+                        next_standard_error,
+                    )
+                formatted_chains.append(
+                    {
+                        "name": chain,
+                        "avg_price": round(avg_price, 2),
+                        "avg_price_ci": self.__interval(avg_price, standard_error),
+                        "rank_confidence": rank_confidence,
+                    }
+                )
+            results.append(
+                {
+                    "ndc": ndc,
+                    "chain": formatted_chains,
+                    "sample_rate": sample.rates.get(ndc, 1.0),
+                }
+            )
+        return results
+
+    @staticmethod
+    def __rank_confidence(
+        difference: float, *standard_errors: Optional[float]
+    ) -> Optional[float]:
+        if any(error is None for error in standard_errors):
+            return None
+        spread = math.sqrt(sum(error**2 for error in standard_errors))
+        if spread == 0:
+            return 1.0 if difference > 0 else 0.5
+        return round(NormalDist().cdf(difference / spread), 4)
+
+    def most_prescribed_quantity_by_drug(self, sample: ClaimSample, allowed_npis=[]):
+        reverted_ids = {revert.claim_id for revert in sample.reverts}
+        counts = {}  # ndc -> quantity -> sampled claims
+        for claim in sample.claims:
+            if claim.id in reverted_ids:
+                continue
+            if allowed_npis and claim.npi not in allowed_npis:
+                continue
+            quantities = counts.setdefault(claim.ndc, {})
+            quantities[claim.quantity] = quantities.get(claim.quantity, 0) + 1
+
+        results = []
+        for ndc, quantities in counts.items():
+            rate = sample.rates.get(ndc, 1.0)
+            ranking = sorted(quantities.items(), key=lambda x: x[1], reverse=True)
+            # Under Bernoulli sampling, var(count_a - count_b) ~ (count_a + count_b)(1 - rate)
+            rank_confidence = [
+                self.__rank_confidence(
+                    count - next_count,
+                    math.sqrt(count * (1 - rate)),
+                    math.sqrt(next_count * (1 - rate)),
+                )
+                for (_, count), (_, next_count) in zip(ranking, ranking[1:])
+            ]
+            results.append(
+                {
+                    "ndc": ndc,
+                    "most_prescribed_quantity": [quantity for quantity, _ in ranking],
+                    "rank_confidence": rank_confidence,
+                    "sample_rate": rate,
+                }
+            )
+        return results
@@ -0,0 +1,71 @@
+from itertools import islice
+from src.models.claim import Claim
+from src.models.revert import Revert
+from typing import Dict, Iterator, List, Optional, Tuple
+
+Partition = Tuple[List[Claim], List[Revert]]
+
+
+def partition_by_ndc(
+    claims: List[Claim],
+    reverts: List[Revert],
+    allowed_npis=[],
+    ndcs=None,
+    npis=None,
+    deduplicate: bool = True,
+) -> Dict[str, Partition]:
+    """
+    Split claims and reverts by ndc, keeping only the requested ndcs/npis.
+
+    Claims keep their order and each revert goes to the partition of the
+    claim it reverts. With deduplicate, only the first claim of each id is
+    kept, as in Analytics.build_cube; duplicates are detected over all the
+    claims so a filtered partition aggregates exactly like the full data.
+    """
+    partitions = {}
+    seen_ids = set()
+    claim_ndcs = {}  # claim id -> ndcs of the partitions holding it
+    for claim in claims:
+        if allowed_npis and claim.npi not in allowed_npis:
+            continue
+        if deduplicate:
+            if claim.id in seen_ids:
+                continue
+            seen_ids.add(claim.id)
+        if (ndcs is not None and claim.ndc not in ndcs) or (
+            npis is not None and claim.npi not in npis
+        ):
+            continue
+
+        partitions.setdefault(claim.ndc, ([], []))[0].append(claim)
+        claim_ndcs.setdefault(claim.id, set()).add(claim.ndc)
+
+    for revert in reverts:
+        for ndc in claim_ndcs.get(revert.claim_id, ()):
+            partitions[ndc][1].append(revert)
+    return partitions
+
+
+def parse_cursor(cursor: Optional[str]) -> Tuple[str, ...]:
+    return tuple(cursor.split(":")) if cursor else ()
+
+
+def result_cursor(result: Dict) -> str:
+    """Cursor of a streamed result: its ndc, followed by its npi for metrics"""
+    if "npi" in result:
+        return f"{result['ndc']}:{result['npi']}"
+    return result["ndc"]
+
+
+def take_page(
+    results: Iterator[Dict], page_size: int
+) -> Tuple[List[Dict], Optional[str]]:
+    """
+    Take the next page_size results, returning them with the cursor to pass
+    to get the following page (None when there are no more results)
+    """
+    page = list(islice(results, page_size + 1))
+    if len(page) <= page_size:
+        return page, None
+    page = page[:page_size]
+    return page, result_cursor(page[-1])
@@ -0,0 +1,58 @@
+import random
+import pytest
+from src.models.claim import Claim
+from src.models.revert import Revert
+from src.models.pharmacy import Pharmacy
+from typing import Dict, List, Optional, Sequence, Tuple
+
+
+def random_dataset(
+    seed: int,
+    claim_count: int,
+    npis: Sequence[str],
+    ndcs: Sequence[str],
+    id_pool: Optional[int] = None,
+    revert_count: int = 0,
+    revert_pool: Optional[int] = None,
+    quantities: Sequence[float] = (1.0, 8.5, 30.0, 90.0),
+    price_range: Tuple[float, float] = (0.01, 5000),
+    chains: Dict[str, str] = {},
+) -> Tuple[List[Claim], List[Revert], List[Pharmacy]]:
+    """
+    Random claims, reverts and pharmacies, the same for a given seed.
+
+    Claim ids are claim-0, claim-1, ... unless id_pool is set, in which case
+    they are drawn among id_pool ids (so some are duplicated). Reverts point
+    to claim ids drawn among revert_pool ids (by default, the claim ids): a
+    larger pool makes some reverts point to claims that do not exist. chains
+    maps npi -> chain of the pharmacies.
+    """
+    rng = random.Random(seed)
+    claims = [
+        Claim(
+            id=f"claim-{i if id_pool is None else rng.randrange(id_pool)}",
+            ndc=rng.choice(ndcs),
+            npi=rng.choice(npis),
+            quantity=rng.choice(quantities),
+            price=round(rng.uniform(*price_range), 2),
+            timestamp="2024-03-01T21:09:01",
+        )
+        for i in range(claim_count)
+    ]
+    if revert_pool is None:
+        revert_pool = id_pool if id_pool is not None else claim_count
+    reverts = [
+        Revert(
+            id=f"revert-{i}",
+            claim_id=f"claim-{rng.randrange(revert_pool)}",
+            timestamp="2024-04-02T21:41:19",
+        )
+        for i in range(revert_count)
+    ]
+    pharmacies = [Pharmacy(chain=chain, npi=npi) for npi, chain in chains.items()]
+    return claims, reverts, pharmacies
+
+
+@pytest.fixture
+def make_dataset():
+    return random_dataset
@@ -0,0 +1,95 @@
+import pytest
+from src.services.analytics import Analytics
+from src.services.aggregate_cube import AggregateCube
+from src.models.claim import Claim
+from src.models.pharmacy import Pharmacy
+
+
+@pytest.fixture
+def claims():
+    return [
+        Claim(
+            id="194c7bbc-c9f6-4d6f-a4c7-83028ae2c857",
+            ndc="00015066812",
+            npi="1234567890",
+            quantity=10.0,
+            price=300.0,
+            timestamp="2024-03-01T21:09:01",
+        ),
+        Claim(
+            id="204c7bbc-c9f6-4d6f-a4c7-83028ae2c852",
+            ndc="00015066812",
+            npi="7890123456",
+            quantity=5.0,
+            price=100.0,
+            timestamp="2024-03-01T21:09:01",
+        ),
+        Claim(
+            id="214c7bbc-c9f6-4d6f-a4c7-83028ae2c853",
+            ndc="00002323401",
+            npi="7890123456",
+            quantity=10.0,
+            price=210.0,
+            timestamp="2024-03-01T21:09:01",
+        ),
+    ]
+
+
+@pytest.fixture
+def pharmacies():
+    return [
+        Pharmacy(chain="health", npi="1234567890"),
+        Pharmacy(chain="saint", npi="7890123456"),
+    ]
+
+
+def test_cube_rollups(claims, pharmacies):
+    cube = Analytics().build_cube(claims=claims, reverts=[], pharmacies=pharmacies)
+
+    assert cube.cells[("7890123456", "00015066812")]["total_price"] == 100.0
+    assert cube.chain_cells[("saint", "00015066812")]["total_quantity"] == 5.0
+    assert cube.ndc_cells["00015066812"]["fills"] == 2
+    assert cube.ndc_cells["00015066812"]["total_price"] == 400.0
+    assert cube.npi_cells["7890123456"]["fills"] == 2
+    assert cube.npi_cells["7890123456"]["total_quantity"] == 15.0
+
+
+def test_cube_remap_chains(claims, pharmacies):
+    analytics = Analytics()
+    cube = analytics.build_cube(claims=claims, reverts=[], pharmacies=pharmacies)
+    cells_before = dict(cube.cells)
+
+    cube.remap_chains(
+        [
+            Pharmacy(chain="health", npi="1234567890"),
+            Pharmacy(chain="health", npi="7890123456"),
+        ]
+    )
+
+    assert cube.cells == cells_before
+    assert ("saint", "00015066812") not in cube.chain_cells
+    assert cube.chain_cells[("health", "00015066812")]["total_price"] == 400.0
+    results = analytics.drug_recommendation_from_cube(cube)
+    assert results[0]["chain"] == [{"name": "health", "avg_price": 26.67}]
+
+
+def test_cube_save_and_load(claims, pharmacies, tmp_path):
+    analytics = Analytics()
+    cube = analytics.build_cube(claims=claims, reverts=[], pharmacies=pharmacies)
+    path = str(tmp_path / "cube.json")
+    cube.save(path)
+
+    loaded = AggregateCube.load(path)
+
+    assert loaded.cells == cube.cells
+    assert loaded.chain_cells == cube.chain_cells
+    assert loaded.ndc_cells == cube.ndc_cells
+    assert loaded.npi_cells == cube.npi_cells
+    assert analytics.metrics_from_cube(loaded) == analytics.compute_metrics(
+        claims=claims, reverts=[]
+    )
+    assert analytics.drug_recommendation_from_cube(
+        loaded
+    ) == analytics.drug_recommendation_by_chains(
+        claims=claims, reverts=[], pharmacies=pharmacies
+    )
@@ -0,0 +1,89 @@
+import pytest
+from src.services.analytics import Analytics
+from src.services import analytics_numpy
+from src.services.analytics_numpy import NumpyAnalytics
+from src.models.claim_columns import ClaimColumns
+
+NPIS = ["1234567890", "7890123456", "2222222222", "3333333333"]
+NDCS = ["00002323401", "00015066812", "00093752910"]
+
+
+@pytest.fixture
+def dataset(make_dataset):
+    return make_dataset(
+        seed=11,
+        claim_count=1000,
+        npis=NPIS,
+        ndcs=NDCS,
+        id_pool=900,  # some ids are duplicated
+        revert_count=150,
+        revert_pool=1200,  # some claims do not exist
+        chains={"1234567890": "health", "7890123456": "saint", "2222222222": "health"},
+    )
+
+
+@pytest.mark.parametrize("exact_prices", [False, True])
+def test_numpy_engine_matches_reference(dataset, exact_prices):
+    claims, reverts, pharmacies = dataset
+    allowed_npis = [pharmacy.npi for pharmacy in pharmacies]
+    reference = Analytics(exact_prices=exact_prices)
+    engine = NumpyAnalytics(exact_prices=exact_prices)
+
+    assert engine.compute_metrics(
+        claims=claims, reverts=reverts, allowed_npis=allowed_npis
+    ) == reference.compute_metrics(
+        claims=claims, reverts=reverts, allowed_npis=allowed_npis
+    )
+    assert engine.drug_recommendation_by_chains(
+        claims=claims, reverts=reverts, pharmacies=pharmacies
+    ) == reference.drug_recommendation_by_chains(
+        claims=claims, reverts=reverts, pharmacies=pharmacies
+    )
+    assert engine.most_prescribed_quantity_by_drug(
+        claims=claims, reverts=reverts, allowed_npis=allowed_npis
+    ) == reference.most_prescribed_quantity_by_drug(
+        claims=claims, reverts=reverts, allowed_npis=allowed_npis
+    )
+
+
+def test_numpy_engine_survives_hash_collisions(dataset, monkeypatch):
+    claims, reverts, pharmacies = dataset
+    allowed_npis = [pharmacy.npi for pharmacy in pharmacies]
+    hash_strings = analytics_numpy.hash_strings
+    monkeypatch.setattr(
+        analytics_numpy,
+        "hash_strings",
+        lambda values, width=None: hash_strings(values, width) % 3,
+    )
+    reference = Analytics()
+    engine = NumpyAnalytics()
+
+    assert engine.compute_metrics(
+        claims=claims, reverts=reverts, allowed_npis=allowed_npis
+    ) == reference.compute_metrics(
+        claims=claims, reverts=reverts, allowed_npis=allowed_npis
+    )
+    assert engine.most_prescribed_quantity_by_drug(
+        claims=claims, reverts=reverts, allowed_npis=allowed_npis
+    ) == reference.most_prescribed_quantity_by_drug(
+        claims=claims, reverts=reverts, allowed_npis=allowed_npis
+    )
+
+
+def test_numpy_engine_accepts_columns(dataset):
+    claims, reverts, _ = dataset
+    engine = NumpyAnalytics()
+
+    assert engine.compute_metrics(
+        claims=ClaimColumns.from_claims(claims), reverts=reverts
+    ) == engine.compute_metrics(claims=claims, reverts=reverts)
+
+
+def test_numpy_engine_without_claims():
+    engine = NumpyAnalytics()
+
+    assert engine.compute_metrics(claims=[], reverts=[]) == []
+    assert engine.drug_recommendation_by_chains(
+        claims=[], reverts=[], pharmacies=[]
+    ) == []
+    assert engine.most_prescribed_quantity_by_drug(claims=[], reverts=[]) == []
@@ -0,0 +1,102 @@
+import logging
+import random
+import pytest
+from src.services.analytics import Analytics
+from src.services.analytics_numpy import NumpyAnalytics
+from src.services.cent_accumulator import CentAccumulator
+from src.models.claim import Claim
+from src.models.revert import Revert
+from src.models.pharmacy import Pharmacy
+
+
+@pytest.fixture
+def make_claims(make_dataset):
+    return lambda count: make_dataset(
+        seed=7,
+        claim_count=count,
+        npis=["1234567890", "7890123456"],
+        ndcs=["00002323401", "00015066812"],
+    )[0]
+
+
+def test_accumulator_is_exact():
+    key = ("1234567890", "00002323401")
+    accumulator = CentAccumulator(keys=[("7890123456", "00002323401"), key])
+    accumulator.add_batch([1, 1, 1], [0.1, 0.2, 0.3], [1.0, 1.0, 1.0])
+    accumulator.subtract_batch([1], [0.3], [1.0])
+
+    cells = accumulator.to_cells()
+    assert cells[key] == {
+        "fills": 2,
+        "reverted": 1,
+        "total_price": 300000,
+        "total_quantity": 2000000,
+    }
+
+
+def test_exact_prices_independent_of_order(make_claims):
+    claims = make_claims(500)
+    reverts = [
+        Revert(id=f"revert-{i}", claim_id=f"claim-{i}", timestamp="2024-04-02T21:41:19")
+        for i in range(0, 500, 7)
+    ]
+    analytics = Analytics(exact_prices=True)
+
+    expected = analytics.compute_metrics(claims=claims, reverts=reverts)
+    shuffled = list(claims)
+    random.Random(3).shuffle(shuffled)
+    results = analytics.compute_metrics(claims=shuffled, reverts=reverts)
+
+    key = lambda x: (x["npi"], x["ndc"])
+    assert sorted(results, key=key) == sorted(expected, key=key)
+
+
+def test_exact_prices_match_float_rounding(make_claims):
+    claims = make_claims(200)
+    reverts = [
+        Revert(id="revert-1", claim_id="claim-3", timestamp="2024-04-02T21:41:19")
+    ]
+
+    assert Analytics(exact_prices=True).compute_metrics(
+        claims=claims, reverts=reverts
+    ) == Analytics().compute_metrics(claims=claims, reverts=reverts)
+
+
+@pytest.mark.parametrize("engine", [Analytics, NumpyAnalytics])
+def test_exact_prices_keep_values_finer_than_a_cent(engine, make_claims, caplog):
+    claims = [
+        Claim(
+            id=f"fine-{i}",
+            ndc="00002323401",
+            npi="9999999999",
+            quantity=0.0004 if i >= 10 else 1.0,
+            price=0.004 if i < 10 else 10.0,
+            timestamp="2024-03-01T21:09:01",
+        )
+        for i in range(13)
+    ] + make_claims(5)
+    reverts = [
+        Revert(id="revert-1", claim_id="fine-2", timestamp="2024-04-02T21:41:19")
+    ]
+    exact, default = engine(exact_prices=True), engine()
+
+    with caplog.at_level(logging.WARNING):
+        # Sub-cent prices and sub-thousandth quantities are neither rounded to 0
+        # nor dropped: all three goals agree with the default mode
+        assert exact.compute_metrics(claims, reverts) == default.compute_metrics(
+            claims, reverts
+        )
+        pharmacies = [Pharmacy(chain="health", npi="9999999999")]
+        assert exact.drug_recommendation_by_chains(
+            claims, reverts, pharmacies
+        ) == default.drug_recommendation_by_chains(claims, reverts, pharmacies)
+        assert exact.most_prescribed_quantity_by_drug(
+            claims, reverts
+        ) == default.most_prescribed_quantity_by_drug(claims, reverts)
+    assert "rounded" not in caplog.text
+
+    # Values finer than a millionth are rounded, with a warning
+    finer = claims[:1] + [claims[1].model_copy(update={"price": 0.0000004})]
+    cells = exact.build_cube(claims=finer, reverts=[]).cells
+    assert cells[("9999999999", "00002323401")]["total_price"] == 4000
+    assert "1 claims have a price or quantity finer than a millionth" in caplog.text
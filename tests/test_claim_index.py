@@ -0,0 +1,144 @@
+import pytest
+from src.repository.claim_index import ClaimIndex
+from src.repository.quarantine import QuarantineSink
+from src.services.analytics import Analytics
+from src.models.claim import Claim
+from src.models.revert import Revert
+
+
+def make_claim(claim_id, price=10.0, quantity=2.0):
+    return Claim(
+        id=claim_id,
+        ndc="00002323401",
+        npi="1234567890",
+        quantity=quantity,
+        price=price,
+        timestamp="2024-03-01T21:09:01",
+    )
+
+
+def test_claim_index_persists_and_grows(tmp_path):
+    path = str(tmp_path / "claim_index.bin")
+    index = ClaimIndex(path, initial_capacity=4)
+    for i in range(100):
+        assert index.add(f"claim-{i}", "1234567890", "00002323401", float(i), 1.0)
+    assert not index.add("claim-5", "1234567890", "00002323401", 5.0, 1.0)
+    index.close()
+
+    index = ClaimIndex(path)
+    assert len(index) == 100
+    assert index.capacity >= 100
+    assert index.get("claim-42").price == 42.0
+    assert "claim-100" not in index
+
+    assert index.mark_reverted("claim-42").ndc == "00002323401"
+    assert index.mark_reverted("claim-42") is None
+    assert index.mark_reverted("claim-100") is None
+    index.close()
+    assert ClaimIndex(path).mark_reverted("claim-42") is None
+
+
+def test_claim_index_rejects_long_keys(tmp_path):
+    index = ClaimIndex(str(tmp_path / "claim_index.bin"))
+    with pytest.raises(ValueError):
+        index.add("claim-1", "1" * 21, "00002323401", 1.0, 1.0)
+
+
+@pytest.mark.parametrize("exact_prices", [False, True])
+def test_reverts_apply_to_previous_runs(tmp_path, exact_prices):
+    analytics = Analytics(
+        exact_prices=exact_prices,
+        claim_index=ClaimIndex(str(tmp_path / "claim_index.bin")),
+    )
+    first_run = analytics.build_cube(
+        claims=[make_claim("claim-1"), make_claim("claim-2", price=30.0)],
+        reverts=[],
+    )
+
+    # Second run: claim-1 is reprocessed, claim-3 is new and claim-2 is reverted twice
+    second_run = analytics.build_cube(
+        claims=[make_claim("claim-1"), make_claim("claim-3", price=50.0)],
+        reverts=[
+            Revert(id="revert-1", claim_id="claim-2", timestamp="2024-04-02T21:41:19"),
+            Revert(id="revert-2", claim_id="claim-2", timestamp="2024-04-02T21:41:19"),
+        ],
+    )
+    first_run.merge(second_run)
+
+    assert analytics.metrics_from_cube(first_run) == [
+        {
+            "npi": "1234567890",
+            "ndc": "00002323401",
+            "fills": 2,
+            "reverted": 1,
+            "avg_price": 15.0,
+            "total_price": 60.0,
+        }
+    ]
+
+
+def test_claim_index_transactions(tmp_path):
+    path = str(tmp_path / "claim_index.bin")
+    index = ClaimIndex(path, initial_capacity=4)
+    index.add("claim-0", "1234567890", "00002323401", 1.0, 1.0)
+
+    index.begin()
+    for i in range(1, 20):
+        assert index.add(f"claim-{i}", "1234567890", "00002323401", float(i), 1.0)
+    assert not index.add("claim-0", "1234567890", "00002323401", 1.0, 1.0)
+    assert index.mark_reverted("claim-0").price == 1.0
+    assert index.mark_reverted("claim-0") is None
+    assert index.mark_reverted("claim-3").price == 3.0
+    assert len(index) == 20
+    index.rollback()
+    assert len(index) == 1
+    assert "claim-3" not in index
+
+    # A prepared but not committed run is discarded unless its generation was saved
+    index.begin()
+    index.add("claim-1", "1234567890", "00002323401", 1.0, 1.0)
+    index.mark_reverted("claim-0")
+    index.prepare(generation=1)
+    index.close()
+    index = ClaimIndex(path)
+    index.recover(generation=0)
+    assert len(index) == 1
+    assert index.mark_reverted("claim-0") is not None
+
+    index = ClaimIndex(str(tmp_path / "other.bin"), initial_capacity=4)
+    index.add("claim-0", "1234567890", "00002323401", 1.0, 1.0)
+    index.begin()
+    for i in range(1, 20):
+        index.add(f"claim-{i}", "1234567890", "00002323401", float(i), 1.0)
+    index.mark_reverted("claim-0")
+    index.mark_reverted("claim-5")
+    index.prepare(generation=1)
+    index.close()
+    for _ in range(2):  # the journal is only applied once
+        index = ClaimIndex(str(tmp_path / "other.bin"))
+        index.recover(generation=1)
+        assert len(index) == 20
+        assert index.mark_reverted("claim-0") is None
+        assert index.mark_reverted("claim-5") is None
+        assert index.get("claim-19").price == 19.0
+        index.close()
+
+
+def test_long_keys_are_quarantined(tmp_path):
+    quarantine = QuarantineSink()
+    analytics = Analytics(
+        claim_index=ClaimIndex(str(tmp_path / "claim_index.bin")),
+        quarantine=quarantine,
+    )
+    long_claim = Claim(
+        id="claim-long",
+        ndc="0" * 21,
+        npi="1234567890",
+        quantity=1.0,
+        price=1.0,
+        timestamp="2024-03-01T21:09:01",
+    )
+    cube = analytics.build_cube(claims=[long_claim, make_claim("claim-1")], reverts=[])
+
+    assert list(cube.cells) == [("1234567890", "00002323401")]
+    assert quarantine.counters == {"not_indexable:npi_ndc": 1}
@@ -2,6 +2,8 @@ import json
 import logging
 import pytest
 from src.repository.json_database import JSONDatabase
+from src.repository.quarantine import QuarantineSink
+from src.repository.chunked_json import chunk_ranges
 from src.models.claim import Claim
 from src.models.revert import Revert
 from src.models.pharmacy import Pharmacy
@@ -67,6 +69,83 @@ def test_retrieve_claims_invalid_record(setup_directories, caplog):
     assert "Fail to process record" in caplog.text
 
 
+def test_retrieve_claims_quarantines_invalid_records(setup_directories, tmp_path):
+    claims_dir, reverts_dir, pharmacies_dir = setup_directories
+    valid_claim = {
+        "id": "01000101",
+        "npi": "125234",
+        "ndc": "00093755",
+        "price": 20.0,
+        "quantity": 50.0,
+        "timestamp": "2024-03-01T21:09:01",
+    }
+    invalid_claim = {"id": "invalid-claim-id", "timestamp": "2024-03-01T21:09:01"}
+    (claims_dir / "claims_file.json").write_text(
+        json.dumps([valid_claim, invalid_claim])
+    )
+    quarantine_dir = tmp_path / "quarantine"
+    db = JSONDatabase(
+        claims_dir=str(claims_dir),
+        reverts_dir=str(reverts_dir),
+        pharmacies_dir=str(pharmacies_dir),
+        quarantine=QuarantineSink(quarantine_dir=str(quarantine_dir), run_id="run"),
+    )
+
+    claims = db.retrieve_claims()
+
+    assert len(claims) == 1
+    assert db.quarantine.counters["missing:npi"] == 1
+    entry = json.loads((quarantine_dir / "quarantine-run.ndjson").read_text())
+    assert entry["offset"] == 1
+    assert entry["source_file"] == str(claims_dir / "claims_file.json")
+    assert entry["record"] == invalid_claim
+
+
+def test_retrieve_claims_from_large_file_in_chunks(setup_directories):
+    claims_dir, reverts_dir, pharmacies_dir = setup_directories
+    records = [
+        {
+            "id": f"claim-{i}",
+            "npi": "125234",
+            "ndc": "00093755",
+            "price": 20.0 + i,
+            "quantity": 50.0,
+            "timestamp": "2024-03-01T21:09:01",
+        }
+        for i in range(50)
+    ]
+    records[37] = {"id": "invalid-claim-id", "timestamp": "2024-03-01T21:09:01"}
+    filepath = claims_dir / "claims_file.json"
+    filepath.write_text(json.dumps(records, indent=2))
+    assert len(chunk_ranges(str(filepath), chunk_size=1000)) > 1
+
+    small_files_db = JSONDatabase(
+        claims_dir=str(claims_dir),
+        reverts_dir=str(reverts_dir),
+        pharmacies_dir=str(pharmacies_dir),
+    )
+    large_files_db = JSONDatabase(
+        claims_dir=str(claims_dir),
+        reverts_dir=str(reverts_dir),
+        pharmacies_dir=str(pharmacies_dir),
+        quarantine=QuarantineSink(quarantine_dir=str(claims_dir.parent), run_id="run"),
+        large_file_threshold=0,
+        chunk_size=1000,
+        parse_workers=2,
+    )
+
+    claims = large_files_db.retrieve_claims()
+    large_files_db.quarantine.close()
+
+    assert claims == small_files_db.retrieve_claims()
+    assert len(claims) == 49
+    entry = json.loads((claims_dir.parent / "quarantine-run.ndjson").read_text())
+    assert entry["offset"] == 37
+    columns = large_files_db.retrieve_claim_columns()
+    assert columns.id.tolist() == [claim.id for claim in claims]
+    assert columns.price.tolist() == [claim.price for claim in claims]
+
+
 def test_retrieve_reverts_success(setup_directories):
     claims_dir, reverts_dir, pharmacies_dir = setup_directories
     valid_revert = {
@@ -120,3 +199,71 @@ def test_retrieve_pharmacies_success(setup_directories):
     assert pharmacies[0].npi == "1234567890"
     assert pharmacies[1].chain == "saint"
     assert pharmacies[1].npi == "0987654321"
+
+
+def test_chunks_do_not_split_inside_strings(setup_directories):
+    claims_dir, reverts_dir, pharmacies_dir = setup_directories
+    ids = ["claim-},{-1", 'claim-\\"},{"-2', "claim-\\", 'claim-"}, {"-4']
+    records = [
+        {
+            "id": ids[i % len(ids)] + str(i),
+            "npi": "125234",
+            "ndc": "00093755",
+            "price": 20.0 + i,
+            "quantity": 50.0,
+            "timestamp": "2024-03-01T21:09:01",
+        }
+        for i in range(20)
+    ]
+    filepath = claims_dir / "claims_file.json"
+    filepath.write_text(json.dumps(records))
+
+    for chunk_size in range(1, 600, 7):
+        ranges = chunk_ranges(str(filepath), chunk_size=chunk_size)
+        content = filepath.read_bytes()
+        parsed = [
+            record
+            for start, end in ranges
+            for record in json.loads(b"[" + content[start:end] + b"]")
+        ]
+        assert parsed == records
+
+    db = JSONDatabase(
+        claims_dir=str(claims_dir),
+        reverts_dir=str(reverts_dir),
+        pharmacies_dir=str(pharmacies_dir),
+        large_file_threshold=0,
+        chunk_size=525,
+        parse_workers=2,
+    )
+    assert [claim.id for claim in db.retrieve_claims()] == [
+        record["id"] for record in records
+    ]
+
+
+@pytest.mark.parametrize("large_file_threshold", [0, 256 * 1024 * 1024])
+def test_rejected_records_are_quarantined_once(setup_directories, large_file_threshold):
+    claims_dir, reverts_dir, pharmacies_dir = setup_directories
+    records = [
+        {"id": "invalid-claim-id", "timestamp": "2024-03-01T21:09:01"},
+        {
+            "id": "01000101",
+            "npi": "125234",
+            "ndc": "00093755",
+            "price": 20.0,
+            "quantity": 50.0,
+            "timestamp": "2024-03-01T21:09:01",
+        },
+    ]
+    (claims_dir / "claims_file.json").write_text(json.dumps(records))
+    db = JSONDatabase(
+        claims_dir=str(claims_dir),
+        reverts_dir=str(reverts_dir),
+        pharmacies_dir=str(pharmacies_dir),
+        large_file_threshold=large_file_threshold,
+        parse_workers=1,
+    )
+
+    assert len(db.retrieve_claims()) == 1
+    assert len(db.retrieve_claim_columns()) == 1
+    assert sum(db.quarantine.counters.values()) == 1
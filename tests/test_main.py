@@ -0,0 +1,278 @@
+import json
+import pickle
+import pytest
+from src import main
+from src.main import build_pipeline
+from src.repository.json_database import JSONDatabase
+from src.models.claim import Claim
+from src.models.claim_columns import ClaimColumns
+from src.repository.claim_index import ClaimIndex
+from src.repository import json_database
+from src.repository.quarantine import QuarantineSink
+from src.services.aggregate_cube import AggregateCube
+from src.services.analytics import Analytics
+from src.services.analytics_numpy import NumpyAnalytics
+
+
+@pytest.fixture
+def data_dirs(tmp_path):
+    claims_dir = tmp_path / "claims"
+    reverts_dir = tmp_path / "reverts"
+    pharmacies_dir = tmp_path / "pharmacies"
+    output_dir = tmp_path / "outputs"
+    for directory in (claims_dir, reverts_dir, pharmacies_dir, output_dir):
+        directory.mkdir()
+
+    claims = [
+        {
+            "id": f"claim-{i}",
+            "npi": ["1234567890", "0987654321"][i % 2],
+            "ndc": ["00002323401", "00015066812"][i % 3 % 2],
+            "price": 10.0 + i,
+            "quantity": 1.0 + i % 4,
+            "timestamp": "2024-03-01T21:09:01",
+        }
+        for i in range(12)
+    ]
+    reverts = [
+        {"id": "revert-1", "claim_id": "claim-3", "timestamp": "2024-04-02T21:41:19"}
+    ]
+    (claims_dir / "claims.json").write_text(json.dumps(claims))
+    (reverts_dir / "reverts.json").write_text(json.dumps(reverts))
+    (pharmacies_dir / "pharmacies.csv").write_text(
+        "chain,npi\nhealth,1234567890\nsaint,0987654321\n"
+    )
+    return tmp_path
+
+
+def make_database(data_dirs, **kwargs):
+    return JSONDatabase(
+        claims_dir=str(data_dirs / "claims"),
+        reverts_dir=str(data_dirs / "reverts"),
+        pharmacies_dir=str(data_dirs / "pharmacies"),
+        **kwargs,
+    )
+
+
+def read_output(data_dirs, name):
+    return json.loads((data_dirs / "outputs" / f"{name}.json").read_text())
+
+
+class CountingAnalytics(Analytics):
+    cubes_built = 0
+
+    def build_cube(self, *args, **kwargs):
+        CountingAnalytics.cubes_built += 1
+        return super().build_cube(*args, **kwargs)
+
+
+def test_chain_remap_reuses_persisted_base_cube(data_dirs):
+    def run():
+        build_pipeline(
+            db_obj=make_database(data_dirs),
+            analytics_service=CountingAnalytics(),
+            output_dir=str(data_dirs / "outputs"),
+            cache_dir=str(data_dirs / "cache"),
+        ).run(targets=["metrics", "drug_recommendation_by_chains"])
+
+    CountingAnalytics.cubes_built = 0
+    run()
+    assert CountingAnalytics.cubes_built == 1
+    metrics = read_output(data_dirs, "metrics")
+    chains = {
+        chain["name"]
+        for result in read_output(data_dirs, "drug_recommendation_by_chains")
+        for chain in result["chain"]
+    }
+    assert chains == {"health", "saint"}
+
+    # Same npis, remapped chains: only the chain roll-up is recomputed
+    (data_dirs / "pharmacies" / "pharmacies.csv").write_text(
+        "chain,npi\nhealth,1234567890\ndoctor,0987654321\n"
+    )
+    run()
+    assert CountingAnalytics.cubes_built == 1
+    assert read_output(data_dirs, "metrics") == metrics
+    chains = {
+        chain["name"]
+        for result in read_output(data_dirs, "drug_recommendation_by_chains")
+        for chain in result["chain"]
+    }
+    assert chains == {"health", "doctor"}
+
+    # A changed npi set rebuilds the base cube
+    (data_dirs / "pharmacies" / "pharmacies.csv").write_text(
+        "chain,npi\nhealth,1234567890\n"
+    )
+    run()
+    assert CountingAnalytics.cubes_built == 2
+    assert {result["npi"] for result in read_output(data_dirs, "metrics")} == {
+        "1234567890"
+    }
+
+
+def test_persisted_cube_answers_goal_3(data_dirs):
+    build_pipeline(
+        db_obj=make_database(data_dirs),
+        analytics_service=Analytics(),
+        output_dir=str(data_dirs / "outputs"),
+        cache_dir=str(data_dirs / "cache"),
+    ).run(targets=["drug_recommendation_by_chains"])
+    expected = read_output(data_dirs, "drug_recommendation_by_chains")
+    assert expected
+
+    (cube_path,) = (data_dirs / "cache").glob("cube-*.pkl")
+    with open(cube_path, "rb") as f:
+        cube = pickle.load(f)
+    assert Analytics().drug_recommendation_from_cube(cube) == expected
+
+
+def test_numpy_engine_reads_small_files_as_columns(data_dirs, monkeypatch):
+    targets = ["metrics", "most_prescribed_quantity_by_drug"]
+    build_pipeline(
+        db_obj=make_database(data_dirs),
+        analytics_service=Analytics(),
+        output_dir=str(data_dirs / "outputs"),
+    ).run(targets=targets)
+    expected = {name: read_output(data_dirs, name) for name in targets}
+
+    conversions = []
+    from_claims = ClaimColumns.from_claims
+    monkeypatch.setattr(
+        ClaimColumns,
+        "from_claims",
+        lambda claims: conversions.append(len(claims)) or from_claims(claims),
+    )
+    build_pipeline(
+        db_obj=make_database(data_dirs),
+        analytics_service=NumpyAnalytics(),
+        output_dir=str(data_dirs / "outputs"),
+    ).run(targets=targets)
+
+    assert conversions == []
+    assert {name: read_output(data_dirs, name) for name in targets} == expected
+
+
+def test_numpy_engine_reads_large_files_as_columns(data_dirs, monkeypatch):
+    targets = ["metrics", "most_prescribed_quantity_by_drug"]
+    build_pipeline(
+        db_obj=make_database(data_dirs),
+        analytics_service=Analytics(),
+        output_dir=str(data_dirs / "outputs"),
+    ).run(targets=targets)
+    expected = {name: read_output(data_dirs, name) for name in targets}
+
+    def no_claims(*args):
+        raise AssertionError("Claim objects were built")
+
+    models_from_columns = json_database.models_from_columns
+    monkeypatch.setattr(
+        json_database,
+        "models_from_columns",
+        lambda columns, model: (
+            no_claims() if model is Claim else models_from_columns(columns, model)
+        ),
+    )
+    monkeypatch.setattr(ClaimColumns, "from_claims", no_claims)
+    build_pipeline(
+        db_obj=make_database(data_dirs, large_file_threshold=0, parse_workers=1),
+        analytics_service=NumpyAnalytics(),
+        output_dir=str(data_dirs / "outputs"),
+    ).run(targets=targets)
+
+    assert {name: read_output(data_dirs, name) for name in targets} == expected
+
+
+def run_incremental(data_dirs, exact_prices=False):
+    claim_index = ClaimIndex(str(data_dirs / "state" / "claim_index.bin"))
+    try:
+        build_pipeline(
+            db_obj=make_database(data_dirs),
+            analytics_service=Analytics(
+                exact_prices=exact_prices, claim_index=claim_index
+            ),
+            output_dir=str(data_dirs / "outputs"),
+            state_dir=str(data_dirs / "state"),
+        ).run(targets=["metrics"])
+    finally:
+        claim_index.close()
+    return read_output(data_dirs, "metrics")
+
+
+def add_claims_file(data_dirs):
+    claim = {
+        "id": "claim-new",
+        "npi": "1234567890",
+        "ndc": "00071015527",
+        "price": 7.0,
+        "quantity": 1.0,
+        "timestamp": "2024-03-02T21:09:01",
+    }
+    (data_dirs / "claims" / "claims-2.json").write_text(json.dumps([claim]))
+
+
+def new_ndc_fills(metrics):
+    return [result["fills"] for result in metrics if result["ndc"] == "00071015527"]
+
+
+def test_failed_incremental_runs_keep_the_claims_unprocessed(data_dirs, monkeypatch):
+    (data_dirs / "state").mkdir()
+    expected = run_incremental(data_dirs)
+    add_claims_file(data_dirs)
+
+    # Incompatible options are detected before the claim index is touched
+    with pytest.raises(ValueError):
+        run_incremental(data_dirs, exact_prices=True)
+
+    # A run failing after the index was updated in memory is rolled back
+    def fail(cube, path):
+        raise OSError("disk full")
+
+    monkeypatch.setattr(AggregateCube, "save", fail)
+    with pytest.raises(OSError):
+        run_incremental(data_dirs)
+    monkeypatch.undo()
+
+    metrics = run_incremental(data_dirs)
+    assert new_ndc_fills(metrics) == [1]
+    assert [result for result in metrics if result["ndc"] != "00071015527"] == expected
+
+    # The next run ignores the claims already processed
+    assert new_ndc_fills(run_incremental(data_dirs)) == [1]
+
+
+def test_saved_state_cube_answers_goal_3(data_dirs):
+    (data_dirs / "state").mkdir()
+    run_incremental(data_dirs)
+    add_claims_file(data_dirs)
+    run_incremental(data_dirs)
+
+    build_pipeline(
+        db_obj=make_database(data_dirs),
+        analytics_service=Analytics(),
+        output_dir=str(data_dirs / "outputs"),
+    ).run(targets=["drug_recommendation_by_chains"])
+    cube = AggregateCube.load(str(data_dirs / "state" / "cube.json"))
+    assert cube.chain_cells
+    by_ndc = lambda results: sorted(results, key=lambda x: x["ndc"])
+    assert by_ndc(Analytics().drug_recommendation_from_cube(cube)) == by_ndc(
+        read_output(data_dirs, "drug_recommendation_by_chains")
+    )
+
+
+def test_sampled_engine_shares_the_run_quarantine(data_dirs, monkeypatch):
+    engines = []
+    monkeypatch.setattr(
+        main, "ApproximateAnalytics", lambda analytics: engines.append(analytics)
+    )
+    quarantine = QuarantineSink()
+    build_pipeline(
+        db_obj=make_database(data_dirs),
+        analytics_service=NumpyAnalytics(quarantine=quarantine),
+        output_dir=str(data_dirs / "outputs"),
+        sample_rate=0.5,
+    )
+
+    (engine,) = engines
+    assert type(engine) is NumpyAnalytics
+    assert engine.quarantine is quarantine
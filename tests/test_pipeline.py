@@ -0,0 +1,166 @@
+import threading
+import pytest
+from src.pipeline.pipeline import Pipeline, Stage
+
+
+def test_pipeline_runs_stages_in_dependency_order():
+    pipeline = Pipeline(
+        stages=[
+            Stage("a", lambda: 2),
+            Stage("b", lambda: 3),
+            Stage("product", lambda a, b: a * b, inputs=["a", "b"]),
+            Stage("unused", lambda: 1 / 0),
+        ]
+    )
+
+    assert pipeline.run(targets=["product"]) == {"product": 6}
+
+
+def test_pipeline_runs_independent_stages_concurrently():
+    # Both stages wait on the barrier, so this only completes if they overlap
+    barrier = threading.Barrier(2, timeout=5)
+    pipeline = Pipeline(
+        stages=[
+            Stage("left", lambda: barrier.wait() is not None),
+            Stage("right", lambda: barrier.wait() is not None),
+        ]
+    )
+
+    assert pipeline.run() == {"left": True, "right": True}
+
+
+def test_pipeline_reuses_persisted_artifacts(tmp_path):
+    calls = []
+    source = {"version": "1"}
+
+    def make_stages():
+        return [
+            Stage(
+                "source",
+                lambda: calls.append("source") or 10,
+                fingerprint=lambda: source["version"],
+            ),
+            Stage(
+                "aggregate",
+                lambda source: calls.append("aggregate") or source + 1,
+                inputs=["source"],
+                persist=True,
+            ),
+        ]
+
+    assert Pipeline(make_stages(), cache_dir=str(tmp_path)).run() == {
+        "source": 10,
+        "aggregate": 11,
+    }
+    assert calls == ["source", "aggregate"]
+
+    # The persisted aggregate is reused and its inputs are not recomputed
+    calls.clear()
+    assert Pipeline(make_stages(), cache_dir=str(tmp_path)).run(
+        targets=["aggregate"]
+    ) == {"aggregate": 11}
+    assert calls == []
+
+    # A changed source invalidates the persisted aggregate
+    source["version"] = "2"
+    Pipeline(make_stages(), cache_dir=str(tmp_path)).run(targets=["aggregate"])
+    assert calls == ["source", "aggregate"]
+
+
+def test_pipeline_rejects_unknown_inputs():
+    with pytest.raises(ValueError):
+        Pipeline(stages=[Stage("a", lambda b: b, inputs=["b"])])
+
+
+def test_pipeline_keys_stages_by_value(tmp_path):
+    calls = []
+    source = {"version": "1", "values": [3, 1, 2]}
+
+    def make_stages():
+        return [
+            Stage(
+                "source",
+                lambda: list(source["values"]),
+                fingerprint=lambda: source["version"],
+            ),
+            Stage(
+                "maximum",
+                lambda source: max(source),
+                inputs=["source"],
+                key_by_value=True,
+            ),
+            Stage(
+                "aggregate",
+                lambda maximum: calls.append("aggregate") or maximum * 10,
+                inputs=["maximum"],
+                persist=True,
+            ),
+        ]
+
+    assert Pipeline(make_stages(), cache_dir=str(tmp_path)).run(
+        targets=["aggregate"]
+    ) == {"aggregate": 30}
+
+    # The source changed but not the value the aggregate depends on
+    source.update(version="2", values=[3, 0])
+    assert Pipeline(make_stages(), cache_dir=str(tmp_path)).run(
+        targets=["aggregate"]
+    ) == {"aggregate": 30}
+    assert calls == ["aggregate"]
+
+    source.update(version="3", values=[4])
+    assert Pipeline(make_stages(), cache_dir=str(tmp_path)).run(
+        targets=["aggregate", "maximum"]
+    ) == {"aggregate": 40, "maximum": 4}
+    assert calls == ["aggregate", "aggregate"]
+
+    with pytest.raises(ValueError):
+        Stage("maximum", max, persist=True, key_by_value=True)
+
+
+def test_pipeline_runs_stages_keyed_by_value_with_the_others(tmp_path):
+    # The stage keyed by value waits on the barrier with an independent stage
+    barrier = threading.Barrier(2, timeout=5)
+    calls = []
+
+    def make_stages():
+        return [
+            Stage("source", lambda: [3, 1, 2]),
+            Stage(
+                "maximum",
+                lambda source: barrier.wait() is not None and max(source),
+                inputs=["source"],
+                key_by_value=True,
+            ),
+            Stage("other", lambda: barrier.wait() is not None),
+            Stage("rows", lambda: calls.append("rows") or [1, 2]),
+            Stage(
+                "aggregate",
+                lambda maximum, rows: calls.append("aggregate") or maximum * len(rows),
+                inputs=["maximum", "rows"],
+                persist=True,
+            ),
+        ]
+
+    assert Pipeline(make_stages(), cache_dir=str(tmp_path)).run(
+        targets=["aggregate", "other"]
+    ) == {"aggregate": 6, "other": True}
+    assert calls == ["rows", "aggregate"]
+
+    # Once the key of the aggregate is known, its other inputs are not run
+    assert Pipeline(make_stages(), cache_dir=str(tmp_path)).run(
+        targets=["aggregate", "other"]
+    ) == {"aggregate": 6, "other": True}
+    assert calls == ["rows", "aggregate"]
+
+
+def test_pipeline_detects_cycles():
+    pipeline = Pipeline(
+        stages=[
+            Stage("a", lambda b: b, inputs=["b"], key_by_value=True),
+            Stage("b", lambda a: a, inputs=["a"]),
+        ]
+    )
+
+    with pytest.raises(ValueError):
+        pipeline.run()
@@ -0,0 +1,110 @@
+import random
+import pytest
+from src.services.analytics import Analytics
+from src.services.quantile_sketch import QuantileSketch, merge_sketch_maps
+from src.models.claim import Claim
+from src.models.revert import Revert
+from src.models.pharmacy import Pharmacy
+
+
+def exact_quantile(values, q):
+    values = sorted(values)
+    return values[int(q * (len(values) - 1))]
+
+
+def test_sketch_quantiles_within_relative_accuracy():
+    rng = random.Random(5)
+    values = [rng.lognormvariate(3, 1.5) for _ in range(10000)]
+    sketch = QuantileSketch(relative_accuracy=0.01)
+    for value in values:
+        sketch.add(value)
+
+    for q in (0.5, 0.9, 0.99):
+        exact = exact_quantile(values, q)
+        assert abs(sketch.quantile(q) - exact) <= 0.01 * exact
+
+
+def test_sketch_merge_and_remove():
+    rng = random.Random(6)
+    values = [rng.uniform(1, 1000) for _ in range(2000)]
+    left, right, whole = QuantileSketch(), QuantileSketch(), QuantileSketch()
+    for i, value in enumerate(values):
+        (left if i % 2 else right).add(value)
+        whole.add(value)
+    left.merge(right)
+    assert left.buckets == whole.buckets
+
+    for value in values[:1000]:
+        whole.remove(value)
+    remaining = QuantileSketch()
+    for value in values[1000:]:
+        remaining.add(value)
+    assert whole.buckets == remaining.buckets
+    assert whole.count == 1000
+
+    with pytest.raises(ValueError):
+        QuantileSketch().remove(10.0)
+
+
+def test_sketch_memory_is_bounded():
+    sketch = QuantileSketch(max_buckets=64)
+    for exponent in range(-50, 50):
+        sketch.add(10.0**exponent)
+
+    assert len(sketch.buckets) == 64
+    assert sketch.count == 100
+    assert sketch.quantile(1.0) == pytest.approx(1e49, rel=0.01)
+
+
+def test_sketch_serialization():
+    sketch = QuantileSketch()
+    for value in (0.0, 1.5, 20.0, 20.0):
+        sketch.add(value)
+
+    loaded = QuantileSketch.from_dict(sketch.to_dict())
+
+    assert loaded.buckets == sketch.buckets
+    assert loaded.count == 4
+    assert loaded.quantile(0.5) == sketch.quantile(0.5)
+
+
+def test_unit_price_percentiles():
+    claims = [
+        Claim(
+            id=f"claim-{i}",
+            ndc="00015066812",
+            npi="1234567890" if i % 2 else "7890123456",
+            quantity=2.0,
+            price=2.0 * (i + 1),
+            timestamp="2024-03-01T21:09:01",
+        )
+        for i in range(100)
+    ]
+    reverts = [
+        Revert(id="revert-1", claim_id="claim-99", timestamp="2024-04-02T21:41:19")
+    ]
+    pharmacies = [
+        Pharmacy(chain="health", npi="1234567890"),
+        Pharmacy(chain="health", npi="7890123456"),
+    ]
+    analytics = Analytics()
+
+    results = analytics.unit_price_percentiles(
+        claims=claims, reverts=reverts, pharmacies=pharmacies
+    )
+
+    assert len(results["pharmacies"]) == 2
+    assert results["chains"][0]["chain"] == "health"
+    assert results["chains"][0]["ndc"] == "00015066812"
+    # Unit prices 1..99 remain after the revert
+    assert results["chains"][0]["p50"] == pytest.approx(50, rel=0.01)
+    assert results["chains"][0]["p99"] == pytest.approx(98, rel=0.01)
+
+    # Sketches built from two partitions merge into the same result
+    first = analytics.build_price_sketches(claims=claims[:50], reverts=[])
+    second = analytics.build_price_sketches(claims=claims[50:], reverts=[])
+    merged = merge_sketch_maps(first, second)
+    merged[("1234567890", "00015066812")].remove(200.0 / 2.0)
+    assert (
+        analytics.unit_price_percentiles_from_sketches(merged, pharmacies) == results
+    )
@@ -0,0 +1,65 @@
+import json
+import logging
+from src.models.claim import Claim
+from src.repository.quarantine import QuarantineSink
+
+
+def make_error(record):
+    try:
+        Claim(**record)
+    except Exception as ex:
+        return ex
+
+
+def test_quarantine_writes_batches(tmp_path):
+    sink = QuarantineSink(quarantine_dir=str(tmp_path), run_id="run", batch_size=2)
+    record = {"id": "invalid-claim-id", "timestamp": "2024-03-01T21:09:01"}
+    error = make_error(record)
+
+    sink.reject(record, error, "claims_file.json", 0)
+    assert not (tmp_path / "quarantine-run.ndjson").exists()
+    sink.reject(record, error, "claims_file.json", 1)
+    sink.reject(record, error, "claims_file.json", 2)
+    sink.close()
+
+    lines = (tmp_path / "quarantine-run.ndjson").read_text().splitlines()
+    entries = [json.loads(line) for line in lines]
+    assert [entry["offset"] for entry in entries] == [0, 1, 2]
+    assert entries[0]["reason"] == "missing:npi"
+    assert entries[0]["source_file"] == "claims_file.json"
+    assert entries[0]["record"] == record
+
+
+def test_quarantine_counts_and_samples_logs(caplog):
+    sink = QuarantineSink(max_logs_per_interval=2, log_interval=3600)
+    missing_npi = {"id": "1", "timestamp": "2024-03-01T21:09:01"}
+    invalid_price = {
+        "id": "2",
+        "npi": "1",
+        "ndc": "1",
+        "price": "free",
+        "quantity": 1.0,
+        "timestamp": "2024-03-01T21:09:01",
+    }
+
+    with caplog.at_level(logging.WARNING):
+        for offset in range(100):
+            sink.reject(missing_npi, make_error(missing_npi), "claims.json", offset)
+        sink.reject(invalid_price, make_error(invalid_price), "claims.json", 100)
+
+    assert sink.counters == {"missing:npi": 100, "float_parsing:price": 1}
+    assert len(caplog.records) == 3
+    assert "free" not in caplog.text
+
+
+def test_quarantine_run_ids_are_unique(tmp_path):
+    sinks = [QuarantineSink(quarantine_dir=str(tmp_path)) for _ in range(2)]
+    for i, sink in enumerate(sinks):
+        sink.reject({"id": i}, "missing", source_file="claims.json", offset=i)
+        sink.flush()
+
+    assert sinks[0].path != sinks[1].path
+    assert sinks[0].run_id[:8] == sinks[1].run_id[:8]  # both start with the date
+    for i, sink in enumerate(sinks):
+        with open(sink.path) as f:
+            assert [json.loads(line)["offset"] for line in f] == [i]
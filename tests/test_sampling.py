@@ -0,0 +1,186 @@
+import json
+import pytest
+from src.repository.json_database import JSONDatabase
+from src.services.analytics import Analytics
+from src.services.sampling import (
+    ApproximateAnalytics,
+    StratifiedSampler,
+    hash_fraction,
+)
+NPIS = ["1234567890", "7890123456", "2222222222"]
+
+
+@pytest.fixture
+def dataset(make_dataset):
+    claims, reverts, pharmacies = make_dataset(
+        seed=21,
+        claim_count=5000,
+        npis=NPIS,
+        ndcs=["00002323401"],
+        revert_count=300,
+        quantities=[1.0, 30.0, 30.0, 30.0, 90.0],
+        price_range=(10, 100),
+        chains={"1234567890": "health", "7890123456": "saint"},
+    )
+    # Every 100th claim has a rare ndc
+    claims = [
+        claim if i % 100 else claim.model_copy(update={"ndc": "00093752910"})
+        for i, claim in enumerate(claims)
+    ]
+    return claims, reverts, pharmacies
+
+
+def test_hash_fraction_is_deterministic():
+    assert hash_fraction("claim-1") == hash_fraction("claim-1")
+    assert 0 <= hash_fraction("claim-1") < 1
+    assert hash_fraction("claim-1") != hash_fraction("claim-2")
+
+
+def test_sample_is_deterministic_and_keeps_reverts_of_sampled_claims(dataset):
+    claims, reverts, _ = dataset
+    sample = StratifiedSampler(rate=0.1).sample(claims, reverts)
+    assert sample == StratifiedSampler(rate=0.1).sample(claims, reverts)
+
+    sampled_ids = {claim.id for claim in sample.claims}
+    assert all(revert.claim_id in sampled_ids for revert in sample.reverts)
+    assert len(sample.reverts) == sum(
+        1 for revert in reverts if revert.claim_id in sampled_ids
+    )
+    assert 350 < len(sample.claims) < 650
+
+
+def test_sample_keeps_enough_claims_of_small_ndcs(dataset):
+    claims, reverts, _ = dataset
+    sample = StratifiedSampler(rate=0.01, min_per_stratum=30).sample(claims, reverts)
+
+    # The rare ndc has 50 claims: its rate is raised to 30 / 50
+    assert sample.rates == {"00002323401": 0.01, "00093752910": 0.6}
+    rare = [claim for claim in sample.claims if claim.ndc == "00093752910"]
+    assert 15 <= len(rare) <= 45
+
+    with pytest.raises(ValueError):
+        StratifiedSampler(rate=0)
+
+
+def test_full_rate_matches_exact_outputs(dataset):
+    claims, reverts, pharmacies = dataset
+    sample = StratifiedSampler(rate=1.0).sample(claims, reverts)
+    approximate = ApproximateAnalytics()
+    exact = Analytics()
+
+    metrics = approximate.compute_metrics(sample)
+    for result in metrics:
+        low, high = result.pop("avg_price_ci")
+        assert low == high == result["avg_price"]
+        assert result.pop("sample_rate") == 1.0
+    assert metrics == exact.compute_metrics(claims, reverts)
+
+    recommendations = approximate.drug_recommendation_by_chains(sample, pharmacies)
+    for result in recommendations:
+        assert result.pop("sample_rate") == 1.0
+        for chain in result["chain"]:
+            chain.pop("avg_price_ci")
+            chain.pop("rank_confidence")
+    assert recommendations == exact.drug_recommendation_by_chains(
+        claims, reverts, pharmacies
+    )
+
+    quantities = approximate.most_prescribed_quantity_by_drug(sample)
+    for result in quantities:
+        assert result.pop("sample_rate") == 1.0
+        assert all(value in (0.5, 1.0) for value in result.pop("rank_confidence"))
+    assert quantities == exact.most_prescribed_quantity_by_drug(claims, reverts)
+
+
+def test_sampled_estimates_carry_error_bounds(dataset):
+    claims, reverts, pharmacies = dataset
+    sample = StratifiedSampler(rate=0.2).sample(claims, reverts)
+    approximate = ApproximateAnalytics(confidence=0.99)
+
+    exact_fills = {
+        (result["npi"], result["ndc"]): result["fills"]
+        for result in Analytics().compute_metrics(claims, reverts)
+    }
+    for result in approximate.compute_metrics(sample, allowed_npis=NPIS[:2]):
+        assert result["npi"] in NPIS[:2]
+        low, high = result["avg_price_ci"]
+        assert low <= result["avg_price"] <= high
+        if result["ndc"] == "00002323401":
+            expected = exact_fills[(result["npi"], result["ndc"])]
+            assert abs(result["fills"] - expected) < 0.2 * expected
+
+    for result in approximate.drug_recommendation_by_chains(sample, pharmacies):
+        for chain in result["chain"]:
+            assert 0 <= chain["rank_confidence"] <= 1
+
+    quantities = approximate.most_prescribed_quantity_by_drug(sample)
+    common = next(r for r in quantities if r["ndc"] == "00002323401")
+    assert common["most_prescribed_quantity"][0] == 30.0
+    assert common["rank_confidence"][0] > 0.99
+    assert len(common["rank_confidence"]) == len(common["most_prescribed_quantity"]) - 1
+
+
+@pytest.mark.parametrize("large_file_threshold", [0, 256 * 1024 * 1024])
+def test_sample_is_drawn_at_ingest(dataset, tmp_path, large_file_threshold):
+    claims, reverts, _ = dataset
+    # Missing quantity: invalid-0 is sampled at a 0.1 rate, invalid-1 is not
+    invalid = [
+        {"id": f"invalid-{i}", "ndc": "00002323401", "timestamp": "2024-03-01T21:09:01"}
+        for i in range(2)
+    ]
+    assert hash_fraction("invalid-0") < 0.1 < hash_fraction("invalid-1")
+    records = [claim.model_dump(mode="json") for claim in claims]
+    for name in ["claims", "reverts", "pharmacies"]:
+        (tmp_path / name).mkdir()
+    (tmp_path / "claims" / "a.json").write_text(json.dumps(records[:2000] + invalid))
+    (tmp_path / "claims" / "b.json").write_text(json.dumps(records[2000:]))
+    (tmp_path / "reverts" / "a.json").write_text(
+        json.dumps([revert.model_dump(mode="json") for revert in reverts])
+    )
+    db = JSONDatabase(
+        claims_dir=str(tmp_path / "claims"),
+        reverts_dir=str(tmp_path / "reverts"),
+        pharmacies_dir=str(tmp_path / "pharmacies"),
+        large_file_threshold=large_file_threshold,
+        parse_workers=1,
+    )
+
+    sampler = StratifiedSampler(rate=0.1)
+    sample = sampler.sample_database(db)
+    expected = sampler.sample(claims, reverts)
+    assert sorted(sample.claims, key=lambda claim: claim.id) == sorted(
+        expected.claims, key=lambda claim: claim.id
+    )
+    assert sample.reverts == expected.reverts
+    assert sample.rates == expected.rates
+
+    # Only the sampled records are validated
+    assert sum(db.quarantine.counters.values()) == 1
+
+
+def test_sample_rates_match_escaped_ndcs(dataset, tmp_path):
+    claims, reverts, pharmacies = dataset
+    # The rare ndc is written with a JSON escape in the raw file
+    text = json.dumps([claim.model_dump(mode="json") for claim in claims]).replace(
+        '"ndc": "00093752910"', '"ndc": "0009375291\\u0030"'
+    )
+    for name in ["claims", "reverts", "pharmacies"]:
+        (tmp_path / name).mkdir()
+    (tmp_path / "claims" / "a.json").write_text(text)
+    db = JSONDatabase(
+        claims_dir=str(tmp_path / "claims"),
+        reverts_dir=str(tmp_path / "reverts"),
+        pharmacies_dir=str(tmp_path / "pharmacies"),
+    )
+
+    sample = StratifiedSampler(rate=0.1).sample_database(db)
+    assert sample.rates == StratifiedSampler(rate=0.1).rates(
+        {"00002323401": 4950, "00093752910": 50}
+    )
+    approximate = ApproximateAnalytics()
+    assert {result["ndc"] for result in approximate.compute_metrics(sample)} == {
+        "00002323401",
+        "00093752910",
+    }
+    approximate.drug_recommendation_by_chains(sample, pharmacies)
+    approximate.most_prescribed_quantity_by_drug(sample)
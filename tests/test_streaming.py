@@ -0,0 +1,142 @@
+import pytest
+from src.services.analytics import Analytics
+from src.services.analytics_numpy import NumpyAnalytics
+from src.services.streaming import take_page
+
+NPIS = ["1234567890", "7890123456", "2222222222", "3333333333"]
+NDCS = ["00002323401", "00015066812", "00093752910", "00071015527"]
+
+
+@pytest.fixture
+def dataset(make_dataset):
+    return make_dataset(
+        seed=17,
+        claim_count=800,
+        npis=NPIS,
+        ndcs=NDCS,
+        id_pool=700,  # duplicated ids, across ndcs too
+        revert_count=120,
+        revert_pool=900,
+        chains={"1234567890": "health", "7890123456": "saint", "2222222222": "doctor"},
+    )
+
+
+def by_key(results):
+    return sorted(results, key=lambda x: (x["ndc"], x.get("npi", "")))
+
+
+@pytest.mark.parametrize("engine", [Analytics, NumpyAnalytics])
+@pytest.mark.parametrize("exact_prices", [False, True])
+def test_streams_match_materialized_results(dataset, engine, exact_prices):
+    claims, reverts, pharmacies = dataset
+    analytics = engine(exact_prices=exact_prices)
+    allowed_npis = NPIS[:3]
+
+    assert list(analytics.iter_metrics(claims, reverts, allowed_npis)) == by_key(
+        analytics.compute_metrics(claims, reverts, allowed_npis)
+    )
+    assert list(
+        analytics.iter_drug_recommendation_by_chains(claims, reverts, pharmacies)
+    ) == by_key(analytics.drug_recommendation_by_chains(claims, reverts, pharmacies))
+    assert list(
+        analytics.iter_most_prescribed_quantity_by_drug(claims, reverts, allowed_npis)
+    ) == by_key(
+        analytics.most_prescribed_quantity_by_drug(claims, reverts, allowed_npis)
+    )
+
+
+def test_filters_select_results_of_the_full_data(dataset):
+    claims, reverts, pharmacies = dataset
+    analytics = Analytics()
+    ndcs, npis = {NDCS[1], NDCS[3]}, {NPIS[0], NPIS[2]}
+
+    metrics = list(analytics.iter_metrics(claims, reverts, ndcs=ndcs, npis=npis))
+    assert metrics == [
+        result
+        for result in by_key(analytics.compute_metrics(claims, reverts))
+        if result["ndc"] in ndcs and result["npi"] in npis
+    ]
+
+    recommendations = list(
+        analytics.iter_drug_recommendation_by_chains(
+            claims, reverts, pharmacies, ndcs={NDCS[2]}
+        )
+    )
+    assert recommendations == [
+        result
+        for result in analytics.drug_recommendation_by_chains(
+            claims, reverts, pharmacies
+        )
+        if result["ndc"] == NDCS[2]
+    ]
+    assert list(analytics.iter_metrics(claims, reverts, ndcs={"unknown"})) == []
+
+
+def test_npis_filter_recomputes_goals_3_and_4_over_their_claims(dataset):
+    claims, reverts, pharmacies = dataset
+    analytics = Analytics()
+    npis = {NPIS[0], NPIS[2]}
+    # Claim ids are deduplicated over all the claims before the npis filter
+    seen_ids = set()
+    first_claims = [
+        claim
+        for claim in claims
+        if claim.id not in seen_ids and not seen_ids.add(claim.id)
+    ]
+    selected = [claim for claim in first_claims if claim.npi in npis]
+
+    assert list(
+        analytics.iter_drug_recommendation_by_chains(
+            claims, reverts, pharmacies, npis=npis
+        )
+    ) == by_key(analytics.drug_recommendation_by_chains(selected, reverts, pharmacies))
+    assert list(
+        analytics.iter_most_prescribed_quantity_by_drug(claims, reverts, npis=npis)
+    ) == by_key(
+        analytics.most_prescribed_quantity_by_drug(
+            [claim for claim in claims if claim.npi in npis], reverts
+        )
+    )
+
+
+def test_streams_are_lazy(dataset, monkeypatch):
+    claims, reverts, _ = dataset
+    analytics = Analytics()
+    built = []
+    build_cube = analytics.build_cube
+    monkeypatch.setattr(
+        analytics,
+        "build_cube",
+        lambda **kwargs: built.append(kwargs["claims"][0].ndc) or build_cube(**kwargs),
+    )
+
+    first = next(analytics.iter_metrics(claims, reverts))
+    assert first["ndc"] == min(NDCS)
+    assert built == [min(NDCS)]
+
+
+def test_cursor_paging(dataset):
+    claims, reverts, _ = dataset
+    analytics = Analytics()
+    expected = list(analytics.iter_metrics(claims, reverts))
+
+    pages, cursor = [], None
+    while True:
+        page, cursor = take_page(
+            analytics.iter_metrics(claims, reverts, cursor=cursor), page_size=5
+        )
+        pages.append(page)
+        if cursor is None:
+            break
+    assert [result for page in pages for result in page] == expected
+    assert all(len(page) == 5 for page in pages[:-1])
+
+    page, cursor = take_page(
+        analytics.iter_most_prescribed_quantity_by_drug(claims, reverts), 3
+    )
+    assert [result["ndc"] for result in page] == sorted(NDCS)[:3]
+    rest = list(
+        analytics.iter_most_prescribed_quantity_by_drug(claims, reverts, cursor=cursor)
+    )
+    assert [result["ndc"] for result in rest] == sorted(NDCS)[3:]
+    assert take_page(iter(rest), 1) == (rest, None)